@@ -73,6 +73,8 @@ function renderAll(data) {
       <p><b>Вернувшихся пользователей:</b> ${esc(formatNum(data.retention.returningUsers))}</p>
       <p><b>Return rate:</b> ${esc(data.retention.returningRate)}%</p>
       <p><b>D1 retention:</b> ${esc(data.retention.d1RetentionRate)}%</p>
+      <p><b>DAU / WAU / MAU:</b> ${esc(formatNum(data.retention.dau))} / ${esc(formatNum(data.retention.wau))} / ${esc(formatNum(data.retention.mau))}</p>
+      <p><b>Режим подсчета:</b> ${data.retention.mode === 'approx' ? 'приблизительный (HyperLogLog)' : 'точный'}</p>
     </div>
   `;
 
@@ -102,11 +104,44 @@ function renderAll(data) {
     <div class="metrics">
       <p><b>Измерений:</b> ${esc(formatNum(data.pageLoad.samples))}</p>
       <p><b>Средняя загрузка:</b> ${esc(formatNum(data.pageLoad.avgMs))} мс</p>
+      <p><b>P50:</b> ${esc(formatNum(data.pageLoad.p50Ms))} мс</p>
+      <p><b>P90:</b> ${esc(formatNum(data.pageLoad.p90Ms))} мс</p>
       <p><b>P95:</b> ${esc(formatNum(data.pageLoad.p95Ms))} мс</p>
+      <p><b>P99:</b> ${esc(formatNum(data.pageLoad.p99Ms))} мс</p>
       <p><b>Максимум:</b> ${esc(formatNum(data.pageLoad.maxMs))} мс</p>
     </div>
   `;
 
+  const geocodeCache = data.caches.geocode;
+  const forecastCache = data.caches.forecast;
+  const coalescing = data.caches.coalescing;
+  const staticCache = data.caches.static;
+  document.getElementById('caches').innerHTML = `
+    <div class="metrics">
+      <p><b>Геокодер, попаданий в память:</b> ${esc(formatNum(geocodeCache.memoryHits))}</p>
+      <p><b>Геокодер, попаданий в БД:</b> ${esc(formatNum(geocodeCache.dbHits))}</p>
+      <p><b>Геокодер, «Город не найден» из кэша:</b> ${esc(formatNum(geocodeCache.negativeHits))}</p>
+      <p><b>Геокодер, промахов:</b> ${esc(formatNum(geocodeCache.misses))}</p>
+      <p><b>Геокодер, hit rate:</b> ${esc(geocodeCache.hitRate)}%</p>
+      <p><b>Прогноз, попаданий:</b> ${esc(formatNum(forecastCache.hits))}</p>
+      <p><b>Прогноз, промахов:</b> ${esc(formatNum(forecastCache.misses))}</p>
+      <p><b>Прогноз, из общего кэша процессов:</b> ${esc(formatNum(forecastCache.sharedHits))}</p>
+      <p><b>Прогноз, hit rate:</b> ${esc(forecastCache.hitRate)}%</p>
+      <p><b>Прогноз, отдано устаревших:</b> ${esc(formatNum(forecastCache.staleHits))}</p>
+      <p><b>Прогрев популярных городов:</b> ${esc(formatNum(data.caches.warmer.prefetched))} прогнозов, ${esc(formatNum(data.caches.warmer.requests))} запросов к API</p>
+      <p><b>Подсказки городов:</b> ${esc(formatNum(data.caches.cityIndex.cities))} городов, ${esc(formatNum(data.caches.cityIndex.queries))} запросов</p>
+      <p><b>Запросов к API, объединено:</b> ${esc(formatNum(coalescing.deduplicated))}</p>
+      <p><b>Статика, отдано из памяти:</b> ${esc(formatNum(staticCache.hits))}</p>
+      <p><b>Статика, ответов 304:</b> ${esc(formatNum(staticCache.notModified))}</p>
+      <p><b>События, отклонено лимитом:</b> ${esc(formatNum(data.ingest.guard.rateLimited))}, слишком больших запросов ${esc(formatNum(data.ingest.guard.tooLarge))}</p>
+      <p><b>События, отброшено выборкой:</b> ${esc(formatNum(data.ingest.guard.sampledOut))}</p>
+      ${Object.entries(data.upstreams.breakers).map(([name, breaker]) => `
+        <p><b>${esc(name)}:</b> ${esc(breaker.state)}, ошибок ${esc(breaker.errorRate)}%,
+          отклонено ${esc(formatNum(breaker.rejected))}, повторов ${esc(formatNum(breaker.retryBudget.retries))}</p>
+      `).join('')}
+    </div>
+  `;
+
   document.getElementById('enteredCities').innerHTML = renderTable(
     data.searchGeo.enteredCities,
     [
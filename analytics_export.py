@@ -0,0 +1,370 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+
+import server
+
+EXPORT_DIR = os.getenv(
+    "ANALYTICS_EXPORT_DIR", os.path.join(os.path.dirname(server.DB_PATH), "analytics_export")
+)
+EXPORT_INTERVAL = float(os.getenv("ANALYTICS_EXPORT_INTERVAL", "3600"))
+EXPORT_GRACE = float(os.getenv("ANALYTICS_EXPORT_GRACE", "600"))
+EXPORT_META_MAX_FIELDS = int(os.getenv("ANALYTICS_EXPORT_META_MAX_FIELDS", "32"))
+EXPORT_FILE_PATTERN = re.compile(r"^events-(\d{4}-\d{2}-\d{2})\.npz$")
+DICTIONARY_COLUMNS = (
+    "event_type",
+    "city_input",
+    "city_resolved",
+    "country",
+    "country_code",
+    "path",
+    "purpose",
+    "error_code",
+)
+TEXT_COLUMNS = ("client_id", "session_id", "target_date", "link_url", "error_message")
+META_KEY = re.compile(r"^[A-Za-z0-9_]{1,64}$")
+BUCKET_SECONDS = {"hour": 3600, "day": 86400}
+
+
+def connect_readonly(db_path: str):
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def day_bounds(day: date):
+    start = int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+    return start, start + 86400
+
+
+def export_path(directory: str, day: date) -> str:
+    return os.path.join(directory, f"events-{day.isoformat()}.npz")
+
+
+def exported_days(directory: str):
+    if not os.path.isdir(directory):
+        return []
+    days = []
+    for name in os.listdir(directory):
+        match = EXPORT_FILE_PATTERN.match(name)
+        if match:
+            days.append(date.fromisoformat(match.group(1)))
+    return sorted(days)
+
+
+def first_event_day(conn):
+    starts = [
+        conn.execute(f"SELECT MIN(ts_epoch) AS ts FROM {name}").fetchone()["ts"]
+        for name in server.list_partitions(conn)
+    ]
+    starts = [ts for ts in starts if ts is not None]
+    if not starts:
+        return None
+    return datetime.fromtimestamp(min(starts), timezone.utc).date()
+
+
+def read_day(conn, day: date):
+    partition = server.partition_for(day.isoformat())
+    if partition not in server.list_partitions(conn):
+        return []
+    start, end = day_bounds(day)
+    return conn.execute(
+        f"""
+        SELECT {", ".join(server.EVENT_COLUMNS)} FROM ({server.decoded_events_sql(partition)})
+        WHERE ts_epoch >= ? AND ts_epoch < ?
+        ORDER BY ts_epoch
+        """,
+        (start, end),
+    ).fetchall()
+
+
+def dictionary_encode(values):
+    codes = np.full(len(values), -1, dtype=np.int32)
+    dictionary = {}
+    for index, value in enumerate(values):
+        if value is None or value == "":
+            continue
+        codes[index] = dictionary.setdefault(value, len(dictionary))
+    return codes, np.array(list(dictionary), dtype=str)
+
+
+def parse_meta(rows):
+    parsed = []
+    for row in rows:
+        try:
+            meta = json.loads(row["meta_json"] or "{}")
+        except json.JSONDecodeError:
+            meta = {}
+        parsed.append(meta if isinstance(meta, dict) else {})
+    keys = Counter(key for meta in parsed for key in meta if META_KEY.match(key))
+    return parsed, [key for key, _ in keys.most_common(EXPORT_META_MAX_FIELDS)]
+
+
+def meta_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def encode_day(rows):
+    arrays = {
+        "ts_epoch": np.array([row["ts_epoch"] for row in rows], dtype=np.int64),
+        "load_ms": np.array(
+            [np.nan if row["load_ms"] is None else row["load_ms"] for row in rows], dtype=np.float64
+        ),
+        "sample_weight": np.array([row["sample_weight"] for row in rows], dtype=np.int32),
+    }
+    for column in DICTIONARY_COLUMNS:
+        codes, dictionary = dictionary_encode([row[column] for row in rows])
+        arrays[f"{column}.codes"] = codes
+        arrays[f"{column}.dict"] = dictionary
+    for column in TEXT_COLUMNS:
+        arrays[column] = np.array([row[column] or "" for row in rows], dtype=str)
+
+    parsed, keys = parse_meta(rows)
+    for key in keys:
+        values = [meta.get(key) for meta in parsed]
+        numeric = all(
+            value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+            for value in values
+        )
+        if numeric:
+            arrays[f"meta.{key}"] = np.array(
+                [np.nan if value is None else value for value in values], dtype=np.float64
+            )
+        else:
+            codes, dictionary = dictionary_encode([meta_value(value) for value in values])
+            arrays[f"meta.{key}.codes"] = codes
+            arrays[f"meta.{key}.dict"] = dictionary
+    return arrays
+
+
+def write_day(directory: str, day: date, rows):
+    path = export_path(directory, day)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez_compressed(file, **encode_day(rows))
+    os.replace(tmp_path, path)
+    return path
+
+
+def export_closed_days(db_path: str, directory: str, now=None):
+    now = now if now is not None else time.time()
+    last_closed = datetime.fromtimestamp(now - EXPORT_GRACE, timezone.utc).date() - timedelta(days=1)
+    os.makedirs(directory, exist_ok=True)
+    done = set(exported_days(directory))
+    written = []
+    conn = connect_readonly(db_path)
+    try:
+        day = first_event_day(conn)
+        while day is not None and day <= last_closed:
+            if day not in done:
+                rows = read_day(conn, day)
+                write_day(directory, day, rows)
+                written.append((day, len(rows)))
+            day += timedelta(days=1)
+    finally:
+        conn.close()
+    return written
+
+
+def to_epoch(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+class EventStore:
+    def __init__(self, directory: str = EXPORT_DIR):
+        self.directory = directory
+        self.loaded = {}
+
+    def days(self, start=None, end=None):
+        days = []
+        for day in exported_days(self.directory):
+            day_start, day_end = day_bounds(day)
+            if (start is None or day_end > start) and (end is None or day_start < end):
+                days.append(day)
+        return days
+
+    def load(self, day: date):
+        arrays = self.loaded.get(day)
+        if arrays is None:
+            with np.load(export_path(self.directory, day)) as data:
+                arrays = self.loaded[day] = {name: data[name] for name in data.files}
+        return arrays
+
+    def column_codes(self, arrays, name: str):
+        size = len(arrays["ts_epoch"])
+        if f"{name}.codes" in arrays:
+            return arrays[f"{name}.codes"] + 1, [None, *arrays[f"{name}.dict"].tolist()]
+        if name not in arrays:
+            return np.zeros(size, dtype=np.int64), [None]
+        labels, codes = np.unique(arrays[name], return_inverse=True)
+        if labels.dtype.kind == "f":
+            return codes.reshape(-1), [None if np.isnan(label) else label for label in labels.tolist()]
+        return codes.reshape(-1), labels.tolist()
+
+    def weights(self, arrays):
+        if "sample_weight" in arrays:
+            return arrays["sample_weight"]
+        return np.ones(len(arrays["ts_epoch"]), dtype=np.int32)
+
+    def column_mask(self, arrays, name: str, values):
+        if not isinstance(values, (list, tuple, set, frozenset)):
+            values = [values]
+        if name in arrays and arrays[name].dtype.kind in "fi":
+            values = [float(value) for value in values]
+        codes, labels = self.column_codes(arrays, name)
+        matched = [code for code, label in enumerate(labels) if label in values]
+        return np.isin(codes, matched)
+
+    def parts(self, start=None, end=None, where=None):
+        start, end = to_epoch(start), to_epoch(end)
+        for day in self.days(start, end):
+            arrays = self.load(day)
+            timestamps = arrays["ts_epoch"]
+            mask = np.ones(len(timestamps), dtype=bool)
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps < end
+            for name, values in (where or {}).items():
+                mask &= self.column_mask(arrays, name, values)
+            yield arrays, mask
+
+    def count(self, start=None, end=None, where=None) -> int:
+        return sum(
+            int(self.weights(arrays)[mask].sum()) for arrays, mask in self.parts(start, end, where)
+        )
+
+    def group_count(self, by, start=None, end=None, where=None, limit=None):
+        names = (by,) if isinstance(by, str) else tuple(by)
+        totals = Counter()
+        for arrays, mask in self.parts(start, end, where):
+            columns = [self.column_codes(arrays, name) for name in names]
+            weights = self.weights(arrays)[mask]
+            if len(columns) == 1:
+                codes, labels = columns[0]
+                counts = np.bincount(codes[mask], weights=weights, minlength=len(labels))
+                for code in np.flatnonzero(counts):
+                    totals[labels[code]] += int(counts[code])
+                continue
+            if not mask.any():
+                continue
+            stacked = np.stack([codes[mask] for codes, _ in columns], axis=1)
+            keys, inverse = np.unique(stacked, axis=0, return_inverse=True)
+            counts = np.bincount(inverse.reshape(-1), weights=weights)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                totals[tuple(labels[code] for code, (_, labels) in zip(key, columns))] += int(count)
+        return totals.most_common(limit)
+
+    def distinct_count(self, column: str, start=None, end=None, where=None) -> int:
+        seen = set()
+        for arrays, mask in self.parts(start, end, where):
+            codes, labels = self.column_codes(arrays, column)
+            seen.update(labels[code] for code in np.unique(codes[mask]).tolist())
+        seen.discard(None)
+        seen.discard("")
+        return len(seen)
+
+    def time_series(self, bucket: str = "day", start=None, end=None, where=None):
+        seconds = BUCKET_SECONDS[bucket]
+        totals = Counter()
+        for arrays, mask in self.parts(start, end, where):
+            keys, inverse = np.unique(arrays["ts_epoch"][mask] // seconds, return_inverse=True)
+            counts = np.bincount(inverse.reshape(-1), weights=self.weights(arrays)[mask])
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                totals[key] += int(count)
+        return [
+            (datetime.fromtimestamp(key * seconds, timezone.utc).isoformat(), totals[key])
+            for key in sorted(totals)
+        ]
+
+
+def parse_where(items):
+    where = {}
+    for item in items or []:
+        name, separator, value = item.partition("=")
+        if not separator:
+            raise argparse.ArgumentTypeError(f"expected column=value, got {item!r}")
+        where.setdefault(name, []).append(value)
+    return where
+
+
+def print_rows(rows):
+    for key, count in rows:
+        label = "\t".join("" if part is None else str(part) for part in key) if isinstance(key, tuple) else key
+        print(f"{'' if label is None else label}\t{count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar export and offline queries for analytics events")
+    parser.add_argument("--dir", default=EXPORT_DIR, help="directory with exported .npz files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="export closed days from the SQLite database")
+    export.add_argument("--db", default=server.DB_PATH)
+    export.add_argument("--watch", action="store_true", help="repeat every --interval seconds")
+    export.add_argument("--interval", type=float, default=EXPORT_INTERVAL)
+
+    for name, help_text in (
+        ("count-by", "grouped event counts"),
+        ("series", "event counts per hour or day"),
+        ("count", "number of matching events"),
+    ):
+        query = commands.add_parser(name, help=help_text)
+        if name == "count-by":
+            query.add_argument("columns", nargs="+")
+            query.add_argument("--limit", type=int, default=20)
+        if name == "series":
+            query.add_argument("--bucket", choices=tuple(BUCKET_SECONDS), default="day")
+        query.add_argument("--from", dest="start")
+        query.add_argument("--to", dest="end")
+        query.add_argument("--where", action="append", metavar="COLUMN=VALUE")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        while True:
+            for day, count in export_closed_days(args.db, args.dir):
+                print(f"{day.isoformat()}: {count} events -> {export_path(args.dir, day)}")
+            if not args.watch:
+                return
+            time.sleep(args.interval)
+
+    try:
+        where = parse_where(args.where)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+    store = EventStore(args.dir)
+    if args.command == "count":
+        print(store.count(args.start, args.end, where))
+    elif args.command == "series":
+        print_rows(store.time_series(args.bucket, args.start, args.end, where))
+    else:
+        columns = args.columns[0] if len(args.columns) == 1 else args.columns
+        print_rows(store.group_count(columns, args.start, args.end, where, args.limit))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(130)
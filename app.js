@@ -41,25 +41,127 @@ function getSessionId() {
 const CLIENT_ID = getClientId();
 const SESSION_ID = getSessionId();
 
-async function trackEvent(eventType, payload = {}) {
+const LOCATION_IDS_KEY = 'weather_location_ids';
+const LOCATION_IDS_LIMIT = 50;
+
+function normalizeCity(city) {
+  return city.toLowerCase().split(/\s+/).filter(Boolean).join(' ');
+}
+
+function getLocationIds() {
+  try {
+    return JSON.parse(localStorage.getItem(LOCATION_IDS_KEY)) || {};
+  } catch {
+    return {};
+  }
+}
+
+function getLocationId(city) {
+  return getLocationIds()[normalizeCity(city)] || '';
+}
+
+function rememberLocationId(city, locationId) {
+  if (!locationId) return;
+  const ids = getLocationIds();
+  const key = normalizeCity(city);
+  delete ids[key];
+  ids[key] = locationId;
+  const keys = Object.keys(ids);
+  keys.slice(0, Math.max(0, keys.length - LOCATION_IDS_LIMIT)).forEach((stale) => delete ids[stale]);
+  localStorage.setItem(LOCATION_IDS_KEY, JSON.stringify(ids));
+}
+
+const citySuggestions = document.getElementById('city-suggestions');
+const SUGGEST_DELAY_MS = 150;
+let suggestedLocationIds = {};
+let suggestTimer = null;
+let suggestController = null;
+
+async function loadSuggestions(query) {
+  if (suggestController) suggestController.abort();
+  suggestController = new AbortController();
   try {
-    await fetch('/api/track', {
+    const response = await fetch(`/api/cities/suggest?q=${encodeURIComponent(query)}`, {
+      signal: suggestController.signal,
+    });
+    if (!response.ok) return;
+    const data = await response.json();
+    suggestedLocationIds = {};
+    citySuggestions.replaceChildren(
+      ...data.suggestions.map((suggestion) => {
+        const key = normalizeCity(suggestion.city);
+        if (!suggestedLocationIds[key]) suggestedLocationIds[key] = suggestion.locationId;
+        const option = document.createElement('option');
+        option.value = suggestion.city;
+        option.label = suggestion.country || '';
+        return option;
+      }),
+    );
+  } catch (_) {
+    // Suggestions are optional; the form still works without them.
+  }
+}
+
+cityInput.addEventListener('input', () => {
+  clearTimeout(suggestTimer);
+  const query = cityInput.value.trim();
+  if (query.length < 2) return;
+  suggestTimer = setTimeout(() => loadSuggestions(query), SUGGEST_DELAY_MS);
+});
+
+const TRACK_FLUSH_DELAY_MS = 5000;
+const TRACK_MAX_BUFFER = 20;
+let trackBuffer = [];
+let trackFlushTimer = null;
+
+function flushEvents(useBeacon = false) {
+  if (trackFlushTimer) {
+    clearTimeout(trackFlushTimer);
+    trackFlushTimer = null;
+  }
+  if (!trackBuffer.length) return;
+
+  const body = JSON.stringify(trackBuffer);
+  trackBuffer = [];
+
+  try {
+    if (useBeacon && navigator.sendBeacon) {
+      const blob = new Blob([body], { type: 'application/json' });
+      if (navigator.sendBeacon('/api/track', blob)) return;
+    }
+    fetch('/api/track', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        eventType,
-        clientId: CLIENT_ID,
-        sessionId: SESSION_ID,
-        path: window.location.pathname,
-        ...payload,
-      }),
+      body,
       keepalive: true,
-    });
+    }).catch(() => {});
   } catch (_) {
     // Avoid surfacing analytics errors to user.
   }
 }
 
+function trackEvent(eventType, payload = {}) {
+  trackBuffer.push({
+    eventType,
+    clientId: CLIENT_ID,
+    sessionId: SESSION_ID,
+    path: window.location.pathname,
+    ...payload,
+  });
+
+  if (trackBuffer.length >= TRACK_MAX_BUFFER) {
+    flushEvents();
+  } else if (!trackFlushTimer) {
+    trackFlushTimer = setTimeout(flushEvents, TRACK_FLUSH_DELAY_MS);
+  }
+}
+
+document.addEventListener('visibilitychange', () => {
+  if (document.visibilityState === 'hidden') flushEvents(true);
+});
+
+window.addEventListener('pagehide', () => flushEvents(true));
+
 function escapeHtml(value) {
   return String(value)
     .replaceAll('&', '&amp;')
@@ -349,7 +451,7 @@ form.addEventListener('submit', async (event) => {
 
   try {
     const response = await fetch(
-      `/api/weather?city=${encodeURIComponent(city)}&date=${encodeURIComponent(selectedDate)}&purpose=${encodeURIComponent(purpose)}&clientId=${encodeURIComponent(CLIENT_ID)}&sessionId=${encodeURIComponent(SESSION_ID)}`,
+      `/api/weather?city=${encodeURIComponent(city)}&date=${encodeURIComponent(selectedDate)}&purpose=${encodeURIComponent(purpose)}&clientId=${encodeURIComponent(CLIENT_ID)}&sessionId=${encodeURIComponent(SESSION_ID)}&locationId=${encodeURIComponent(suggestedLocationIds[normalizeCity(city)] || getLocationId(city))}`,
     );
     const data = await response.json();
 
@@ -357,6 +459,8 @@ form.addEventListener('submit', async (event) => {
       throw new Error(data.error || 'Не удалось получить погоду');
     }
 
+    rememberLocationId(city, data.locationId);
+
     data.purpose = purpose;
     result.innerHTML = formatResult(data);
   } catch (error) {
@@ -0,0 +1,477 @@
+import argparse
+import hashlib
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import server
+
+CITIES = (
+    "Москва",
+    "Санкт-Петербург",
+    "Новосибирск",
+    "Екатеринбург",
+    "Казань",
+    "Нижний Новгород",
+    "Челябинск",
+    "Самара",
+    "Омск",
+    "Ростов-на-Дону",
+    "Уфа",
+    "Красноярск",
+    "Воронеж",
+    "Пермь",
+    "Волгоград",
+    "Краснодар",
+    "Сочи",
+    "Калининград",
+    "Мурманск",
+    "Владивосток",
+)
+PURPOSES = ("walk", "work", "travel", "sport")
+
+
+def fresh_database(directory: str, name: str):
+    server.DB_PATH = os.path.join(directory, name)
+    server.init_db()
+    return server.DB_PATH
+
+
+def restart_writer():
+    server.ANALYTICS_WRITER.close()
+    server.ANALYTICS_WRITER = server.AnalyticsWriter(
+        server.ANALYTICS_QUEUE_SIZE,
+        server.ANALYTICS_BATCH_SIZE,
+        server.ANALYTICS_FLUSH_INTERVAL,
+        server.ANALYTICS_QUEUE_POLICY,
+    )
+
+
+def sample_event(index: int):
+    common = {
+        "client_id": f"c_{index % 500}",
+        "session_id": f"s_{index % 2000}",
+    }
+    kind = index % 20
+    if kind == 0:
+        return "page_perf", {**common, "path": "/", "load_ms": 40 + (index * 7919) % 1500}
+    if kind == 1:
+        return "link_click", {**common, "path": "/", "link_url": "https://yandex.ru/maps/"}
+    if kind == 2:
+        return "error", {
+            **common,
+            "path": "/api/weather",
+            "error_code": "weather_fetch_failed",
+            "error_message": "Город не найден",
+        }
+    if kind % 3 == 0:
+        return "page_view", {**common, "path": "/"}
+    city = CITIES[index % len(CITIES)]
+    return "weather_search", {
+        **common,
+        "path": "/api/weather",
+        "city_input": city,
+        "city_resolved": city,
+        "country": "Россия",
+        "country_code": "RU",
+        "target_date": "2026-01-01",
+        "purpose": PURPOSES[index % len(PURPOSES)],
+    }
+
+
+def sample_row(index: int):
+    event_type, fields = sample_event(index)
+    return server.build_event_row(event_type, **fields)
+
+
+def report(name: str, operations: int, elapsed: float):
+    rate = operations / elapsed if elapsed else float("inf")
+    print(f"{name:<40} {operations:>8} ops  {elapsed:8.3f} s  {rate:12.0f} ops/s")
+
+
+def percentile(values, q: float):
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))]
+
+
+def encode_rows(path: str, rows):
+    conn = sqlite3.connect(path)
+    with conn:
+        encoded, _ = server.EventStrings(len(rows)).encode(conn, rows)
+    conn.close()
+    return encoded
+
+
+def bench_inserts(directory: str, count: int):
+    path = fresh_database(directory, "legacy-insert.db")
+    legacy = sqlite3.connect(path)
+    legacy.execute("PRAGMA journal_mode = DELETE")
+    legacy.close()
+    rows = [sample_row(i) for i in range(count)]
+    table = server.partition_for(rows[0]["ts"])
+    sql = server.INSERT_EVENT_SQL.format(table=table)
+    encoded = encode_rows(path, rows)
+
+    started = time.perf_counter()
+    for row in encoded:
+        conn = sqlite3.connect(path)
+        conn.execute(sql, row)
+        conn.commit()
+        conn.close()
+    report("insert: connection per event (before)", count, time.perf_counter() - started)
+
+    encoded = encode_rows(fresh_database(directory, "pooled-insert.db"), rows)
+    conn = server.db_connect()
+    started = time.perf_counter()
+    for row in encoded:
+        with conn:
+            conn.execute(sql, row)
+    report("insert: reused WAL connection", count, time.perf_counter() - started)
+    conn.close()
+
+    fresh_database(directory, "batched-insert.db")
+    conn = server.db_connect()
+    started = time.perf_counter()
+    for offset in range(0, count, server.ANALYTICS_BATCH_SIZE):
+        server.ANALYTICS_WRITER.write(conn, rows[offset : offset + server.ANALYTICS_BATCH_SIZE])
+    report("insert: batched writer + rollups (after)", count, time.perf_counter() - started)
+    conn.close()
+
+
+def bench_queries(directory: str, count: int):
+    path = fresh_database(directory, "query.db")
+    conn = server.db_connect()
+    server.ANALYTICS_WRITER.write(conn, [sample_row(i) for i in range(1000)])
+    conn.close()
+    sql = "SELECT SUM(count) AS total FROM rollup_counts WHERE metric = 'event' AND key = ?"
+
+    started = time.perf_counter()
+    for _ in range(count):
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        conn.execute(sql, ("page_view",)).fetchone()
+        conn.close()
+    report("query: connection per call (before)", count, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(count):
+        server.query_one(sql, ("page_view",))
+    report("query: pooled read-only connection (after)", count, time.perf_counter() - started)
+
+
+def bench_micro(directory: str, sizes):
+    for size in sizes:
+        fresh_database(directory, f"micro-{size}.db")
+        restart_writer()
+        events = [sample_event(i) for i in range(min(size, 100_000))]
+
+        started = time.perf_counter()
+        for index in range(size):
+            event_type, fields = events[index % len(events)]
+            server.log_event(event_type, **fields)
+        server.ANALYTICS_WRITER.flush()
+        report(f"log_event @ {size:,} events", size, time.perf_counter() - started)
+
+        runs = 3
+        started = time.perf_counter()
+        for _ in range(runs):
+            server.build_analytics_payload()
+        report(f"build_analytics_payload @ {size:,} events", runs, time.perf_counter() - started)
+
+
+def stub_geocode(city: str):
+    digest = hashlib.sha1(city.casefold().encode("utf-8")).digest()
+    return [
+        {
+            "lat": f"{41 + digest[0] / 255 * 25:.4f}",
+            "lon": f"{20 + digest[1] / 255 * 110:.4f}",
+            "display_name": f"{city}, Россия",
+            "address": {"city": city, "country": "Россия", "country_code": "ru"},
+        }
+    ]
+
+
+def stub_forecast(query: dict):
+    latitudes = (query.get("latitude", [""])[0] or "0").split(",")
+    if "start_date" in query:
+        start = date.fromisoformat(query["start_date"][0])
+        days = (date.fromisoformat(query["end_date"][0]) - start).days + 1
+    else:
+        start = date.today() - timedelta(days=1)
+        days = int(query.get("forecast_days", ["16"])[0]) + 1
+
+    def one(latitude: str):
+        base = int(float(latitude))
+        return {
+            "latitude": float(latitude),
+            "daily": {
+                "time": [(start + timedelta(days=i)).isoformat() for i in range(days)],
+                "temperature_2m_min": [base % 15 - 5 + i % 3 for i in range(days)],
+                "temperature_2m_max": [base % 15 + 3 + i % 3 for i in range(days)],
+                "apparent_temperature_min": [base % 15 - 7 + i % 3 for i in range(days)],
+                "apparent_temperature_max": [base % 15 + 1 + i % 3 for i in range(days)],
+                "weather_code": [(0, 3, 61, 71)[i % 4] for i in range(days)],
+            },
+        }
+
+    forecasts = [one(latitude) for latitude in latitudes]
+    return forecasts if len(forecasts) > 1 else forecasts[0]
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.send_json(503, {"error": "stub failure"})
+            return
+
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path == "/search":
+            self.send_json(200, stub_geocode(query.get("q", [""])[0]))
+        elif parsed.path == "/v1/forecast":
+            self.send_json(200, stub_forecast(query))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def send_json(self, status: int, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextmanager
+def stub_upstream(latency: float, error_rate: float):
+    handler = type(
+        "StubHandler", (StubUpstreamHandler,), {"latency": latency, "error_rate": error_rate}
+    )
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    stub.daemon_threads = True
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{stub.server_address[1]}"
+    finally:
+        stub.shutdown()
+        stub.server_close()
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@contextmanager
+def server_process(directory: str, mode: str, nominatim_url: str, open_meteo_url: str, workers: int = 1):
+    port = free_port()
+    env = {
+        **os.environ,
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "SERVER_MODE": mode,
+        "SERVER_WORKERS": str(workers),
+        "DB_PATH": os.path.join(directory, f"load-{mode}.db"),
+        "NOMINATIM_BASE_URL": nominatim_url,
+        "OPEN_METEO_BASE_URL": open_meteo_url,
+    }
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(server.BASE_DIR, "server.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("server.py did not start")
+                time.sleep(0.05)
+        yield port
+    finally:
+        process.terminate()
+        process.wait(15)
+
+
+def weather_request(rng):
+    target = date.today() + timedelta(days=rng.randrange(7))
+    city = rng.choice(CITIES)
+    path = (
+        f"/api/weather?city={quote(city)}&date={target.isoformat()}"
+        f"&purpose={rng.choice(PURPOSES)}&clientId=bench_{rng.randrange(1000)}"
+    )
+    return "GET", path, None, {}
+
+
+def track_request(rng):
+    client_id = f"bench_{rng.randrange(1000)}"
+    events = [
+        {"eventType": "page_view", "clientId": client_id, "path": "/"},
+        {"eventType": "page_perf", "clientId": client_id, "path": "/", "loadMs": rng.randrange(50, 2000)},
+    ]
+    body = json.dumps(events[: rng.randrange(1, 3)]).encode("utf-8")
+    return "POST", "/api/track", body, {"Content-Type": "application/json"}
+
+
+def analytics_request(rng):
+    cookie = f"{server.ANALYTICS_COOKIE_NAME}={server.ANALYTICS_COOKIE_VALUE}"
+    return "GET", "/api/analytics", None, {"Cookie": cookie, "Accept-Encoding": "gzip"}
+
+
+REQUEST_BUILDERS = {
+    "weather": weather_request,
+    "track": track_request,
+    "analytics": analytics_request,
+}
+
+
+def parse_mix(value: str):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in REQUEST_BUILDERS:
+            raise argparse.ArgumentTypeError(f"unknown request kind: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def load_worker(port: int, mix: dict, stop_at: float, seed: int, results: dict):
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while time.monotonic() < stop_at:
+        kind = rng.choices(kinds, weights)[0]
+        method, path, body, headers = REQUEST_BUILDERS[kind](rng)
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            failed = response.status >= 500
+            if response.will_close:
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            failed = True
+        results[kind]["latencies"].append(time.perf_counter() - started)
+        results[kind]["errors"] += failed
+    conn.close()
+
+
+def bench_load(directory: str, args):
+    mix = args.mix
+    with stub_upstream(args.upstream_latency_ms / 1000, args.upstream_error_rate) as nominatim, stub_upstream(
+        args.upstream_latency_ms / 1000, args.upstream_error_rate
+    ) as open_meteo, server_process(
+        directory, args.server_mode, nominatim, open_meteo, args.server_workers
+    ) as port:
+        per_worker = [
+            {kind: {"latencies": [], "errors": 0} for kind in mix} for _ in range(args.concurrency)
+        ]
+        stop_at = time.monotonic() + args.duration
+        started = time.perf_counter()
+        workers = [
+            threading.Thread(target=load_worker, args=(port, mix, stop_at, seed, results))
+            for seed, results in enumerate(per_worker)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+    print(
+        f"load: mode={args.server_mode} workers={args.server_workers} concurrency={args.concurrency} "
+        f"upstream latency={args.upstream_latency_ms:g} ms errors={args.upstream_error_rate:g}"
+    )
+    print(f"{'kind':<12} {'requests':>9} {'errors':>7} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    totals = []
+    for kind in [*mix, "total"]:
+        if kind == "total":
+            latencies = sorted(totals)
+            errors = sum(results[name]["errors"] for results in per_worker for name in mix)
+        else:
+            latencies = sorted(
+                latency for results in per_worker for latency in results[kind]["latencies"]
+            )
+            errors = sum(results[kind]["errors"] for results in per_worker)
+            totals.extend(latencies)
+        print(
+            f"{kind:<12} {len(latencies):>9} {errors:>7} {len(latencies) / elapsed:>9.1f} "
+            f"{percentile(latencies, 0.50) * 1000:>8.1f} "
+            f"{percentile(latencies, 0.95) * 1000:>8.1f} "
+            f"{percentile(latencies, 0.99) * 1000:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for server.py")
+    parser.add_argument(
+        "suites",
+        nargs="*",
+        help="what to run: db, load, micro (default: db)",
+    )
+    parser.add_argument("--inserts", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument(
+        "--micro-sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10_000, 1_000_000, 10_000_000],
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("weather=70,track=25,analytics=5"))
+    parser.add_argument("--server-mode", choices=("threading", "asyncio"), default="threading")
+    parser.add_argument("--server-workers", type=int, default=1)
+    parser.add_argument("--upstream-latency-ms", type=float, default=50)
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    suites = args.suites or ["db"]
+    unknown = set(suites) - {"db", "load", "micro"}
+    if unknown:
+        parser.error(f"unknown suite: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        if "db" in suites:
+            bench_inserts(directory, args.inserts)
+            bench_queries(directory, args.queries)
+        if "micro" in suites:
+            bench_micro(directory, args.micro_sizes)
+            server.ANALYTICS_WRITER.close()
+        if "load" in suites:
+            bench_load(directory, args)
+
+
+if __name__ == "__main__":
+    main()
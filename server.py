@@ -1,629 +1,4380 @@
+import asyncio
+import bisect
+import gzip
+import hashlib
+import http.client
 import json
+import math
+import mimetypes
 import os
+import queue
+import random
+import re
+import signal
+import socket
 import sqlite3
+import ssl
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta, timezone
+from email.utils import formatdate
 from functools import partial
+from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs, quote, urlencode, urlparse
-from urllib.request import Request, urlopen
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 PORT = int(os.getenv("PORT", "10000"))
 HOST = os.getenv("HOST", "0.0.0.0")
+SERVER_MODE = os.getenv("SERVER_MODE", "threading")
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+ANALYTICS_WRITER_SOCKET = os.getenv("ANALYTICS_WRITER_SOCKET", "")
+ASYNC_UPSTREAM_CONCURRENCY = int(os.getenv("ASYNC_UPSTREAM_CONCURRENCY", "32"))
+ASYNC_KEEPALIVE_TIMEOUT = float(os.getenv("ASYNC_KEEPALIVE_TIMEOUT", "15"))
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "analytics.db")
+DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "analytics.db"))
 ANALYTICS_PASSWORD = os.getenv("ANALYTICS_PASSWORD", "1996")
 ANALYTICS_COOKIE_NAME = "analytics_auth"
 ANALYTICS_COOKIE_VALUE = "ok"
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "8"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_STATEMENT_CACHE = 256
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "2048"))
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", "600"))
+ANALYTICS_QUEUE_SIZE = int(os.getenv("ANALYTICS_QUEUE_SIZE", "10000"))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "500"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "0.5"))
+ANALYTICS_QUEUE_POLICY = os.getenv("ANALYTICS_QUEUE_POLICY", "block")
+TRACK_MAX_BATCH_EVENTS = int(os.getenv("TRACK_MAX_BATCH_EVENTS", "200"))
+MAX_REQUEST_BODY_BYTES = int(os.getenv("MAX_REQUEST_BODY_BYTES", str(256 * 1024)))
+TRACK_RATE_LIMIT = float(os.getenv("TRACK_RATE_LIMIT", "20"))
+TRACK_RATE_BURST = int(os.getenv("TRACK_RATE_BURST", "200"))
+TRACK_RATE_MAX_CLIENTS = int(os.getenv("TRACK_RATE_MAX_CLIENTS", "100000"))
+TRACK_SAMPLING = os.getenv("TRACK_SAMPLING", "")
+EVENT_STRINGS_CACHE_SIZE = int(os.getenv("EVENT_STRINGS_CACHE_SIZE", "10000"))
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "30"))
+ANALYTICS_CACHE_MAX_STALE = float(os.getenv("ANALYTICS_CACHE_MAX_STALE", "600"))
+ANALYTICS_UNIQUES_MODE = os.getenv("ANALYTICS_UNIQUES_MODE", "exact")
+ANALYTICS_RAW_RETENTION_DAYS = int(os.getenv("ANALYTICS_RAW_RETENTION_DAYS", "0"))
+ANALYTICS_PRUNE_INTERVAL = float(os.getenv("ANALYTICS_PRUNE_INTERVAL", "3600"))
+NOMINATIM_BASE_URL = os.getenv("NOMINATIM_BASE_URL", "https://nominatim.openstreetmap.org")
+OPEN_METEO_BASE_URL = os.getenv("OPEN_METEO_BASE_URL", "https://api.open-meteo.com")
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "8"))
+NOMINATIM_CONNECT_TIMEOUT = float(os.getenv("NOMINATIM_CONNECT_TIMEOUT", "3"))
+NOMINATIM_READ_TIMEOUT = float(os.getenv("NOMINATIM_READ_TIMEOUT", "10"))
+OPEN_METEO_CONNECT_TIMEOUT = float(os.getenv("OPEN_METEO_CONNECT_TIMEOUT", "3"))
+OPEN_METEO_READ_TIMEOUT = float(os.getenv("OPEN_METEO_READ_TIMEOUT", "10"))
+UPSTREAM_BREAKER_WINDOW = float(os.getenv("UPSTREAM_BREAKER_WINDOW", "30"))
+UPSTREAM_BREAKER_MIN_REQUESTS = int(os.getenv("UPSTREAM_BREAKER_MIN_REQUESTS", "10"))
+UPSTREAM_BREAKER_ERROR_RATE = float(os.getenv("UPSTREAM_BREAKER_ERROR_RATE", "0.5"))
+UPSTREAM_BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "15"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_RETRY_RATIO = float(os.getenv("UPSTREAM_RETRY_RATIO", "0.2"))
+UPSTREAM_RETRY_BUDGET_MAX = float(os.getenv("UPSTREAM_RETRY_BUDGET_MAX", "10"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.1"))
+UPSTREAM_RETRY_BACKOFF_MAX = float(os.getenv("UPSTREAM_RETRY_BACKOFF_MAX", "1"))
+WEATHER_REQUEST_BUDGET = float(os.getenv("WEATHER_REQUEST_BUDGET", "12"))
+WEATHER_GEOCODE_BUDGET_SHARE = float(os.getenv("WEATHER_GEOCODE_BUDGET_SHARE", "0.4"))
+WEATHER_BATCH_MAX_CITIES = int(os.getenv("WEATHER_BATCH_MAX_CITIES", "10"))
+FORECAST_CACHE_SIZE = int(os.getenv("FORECAST_CACHE_SIZE", "2048"))
+FORECAST_GRID_DEG = float(os.getenv("FORECAST_GRID_DEG", "0.05"))
+FORECAST_RUN_INTERVAL = int(os.getenv("FORECAST_RUN_INTERVAL", "3600"))
+FORECAST_STALE_TTL = int(os.getenv("FORECAST_STALE_TTL", "86400"))
+CITY_GAZETTEER_PATH = os.getenv("CITY_GAZETTEER_PATH", os.path.join(BASE_DIR, "cities.tsv"))
+CITY_INDEX_TTL = float(os.getenv("CITY_INDEX_TTL", "300"))
+CITY_SUGGEST_LIMIT = int(os.getenv("CITY_SUGGEST_LIMIT", "8"))
+CITY_SUGGEST_SCAN_LIMIT = 256
+FORECAST_WARM_CITIES = int(os.getenv("FORECAST_WARM_CITIES", "20"))
+FORECAST_WARM_LOOKBACK_DAYS = int(os.getenv("FORECAST_WARM_LOOKBACK_DAYS", "7"))
+FORECAST_WARM_DELAY = float(os.getenv("FORECAST_WARM_DELAY", "120"))
+FORECAST_WARM_BUDGET = int(os.getenv("FORECAST_WARM_BUDGET", "10"))
+FORECAST_DAYS = 16
+FORECAST_DAILY_FIELDS = (
+    "temperature_2m_min",
+    "temperature_2m_max",
+    "apparent_temperature_min",
+    "apparent_temperature_max",
+    "weather_code",
+)
+STATIC_FILES = (
+    "index.html",
+    "analytics.html",
+    "analytics-login.html",
+    "app.js",
+    "analytics.js",
+    "styles.css",
+    "analytics.css",
+)
+STATIC_MIN_COMPRESS_SIZE = 256
+JSON_GZIP_MIN_SIZE = int(os.getenv("JSON_GZIP_MIN_SIZE", "1024"))
+JSON_GZIP_LEVEL = 6
+METRICS_STRIPES = 16
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATIC_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def encode_json(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def db_connect():
-    conn = sqlite3.connect(DB_PATH)
+class StripedCounter:
+    def __init__(self, stripes: int = METRICS_STRIPES):
+        self.stripes = [[threading.Lock(), 0.0] for _ in range(stripes)]
+
+    def inc(self, amount: float = 1):
+        stripe = self.stripes[threading.get_native_id() % len(self.stripes)]
+        with stripe[0]:
+            stripe[1] += amount
+
+    def value(self) -> float:
+        return sum(stripe[1] for stripe in self.stripes)
+
+
+class Histogram:
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS, stripes: int = METRICS_STRIPES):
+        self.buckets = buckets
+        self.stripes = [[threading.Lock(), [0] * (len(buckets) + 1), 0.0] for _ in range(stripes)]
+
+    def observe(self, value: float):
+        stripe = self.stripes[threading.get_native_id() % len(self.stripes)]
+        index = bisect.bisect_left(self.buckets, value)
+        with stripe[0]:
+            stripe[1][index] += 1
+            stripe[2] += value
+
+    def snapshot(self):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for lock, stripe_counts, stripe_sum in self.stripes:
+            with lock:
+                counts = [a + b for a, b in zip(counts, stripe_counts)]
+                total += stripe_sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def metric(self, store: dict, factory, name: str, labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        metric = store.get(key)
+        if metric is None:
+            with self.lock:
+                metric = store.setdefault(key, factory())
+        return metric
+
+    def observe(self, name: str, value: float, **labels):
+        self.metric(self.histograms, Histogram, name, labels).observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        self.metric(self.counters, StripedCounter, name, labels).inc(amount)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+
+METRICS = MetricsRegistry()
+
+
+@contextmanager
+def upstream_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        METRICS.inc("weather_upstream_errors_total", stage=stage, error=type(error).__name__)
+        raise
+    finally:
+        METRICS.observe(
+            "weather_stage_duration_seconds", time.perf_counter() - started, stage=stage
+        )
+
+
+def db_connect(readonly: bool = False):
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=10,
+        check_same_thread=False,
+        cached_statements=SQLITE_STATEMENT_CACHE,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    if readonly:
+        conn.execute("PRAGMA query_only = 1")
     return conn
 
 
+class SQLitePool:
+    def __init__(self, size: int, readonly: bool = False):
+        self.size = size
+        self.readonly = readonly
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.inherited = []
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        while True:
+            try:
+                self.inherited.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.size)
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            try:
+                path, conn = self.idle.get_nowait()
+            except queue.Empty:
+                path, conn = None, None
+            if conn is not None and path != DB_PATH:
+                conn.close()
+                conn = None
+            if conn is None:
+                path, conn = DB_PATH, db_connect(readonly=self.readonly)
+            try:
+                yield conn
+            except BaseException:
+                try:
+                    conn.rollback()
+                except Exception:
+                    conn.close()
+                    raise
+                self.idle.put((path, conn))
+                raise
+            self.idle.put((path, conn))
+        finally:
+            self.slots.release()
+
+
+READ_POOL = SQLitePool(SQLITE_READ_POOL_SIZE, readonly=True)
+WRITE_POOL = SQLitePool(1)
+
+
+EVENT_COLUMNS = (
+    "ts",
+    "ts_epoch",
+    "event_type",
+    "client_id",
+    "session_id",
+    "path",
+    "city_input",
+    "city_resolved",
+    "country",
+    "country_code",
+    "target_date",
+    "purpose",
+    "link_url",
+    "error_code",
+    "error_message",
+    "load_ms",
+    "meta_json",
+    "sample_weight",
+)
+DICTIONARY_EVENT_COLUMNS = (
+    "event_type",
+    "path",
+    "city_resolved",
+    "country",
+    "country_code",
+    "purpose",
+    "error_code",
+)
+STORED_EVENT_COLUMNS = tuple(
+    f"{column}_id" if column in DICTIONARY_EVENT_COLUMNS else column for column in EVENT_COLUMNS
+)
+PARTITION_INDEXES = (
+    ("ts", "ts_epoch"),
+    ("type_ts", "event_type_id, ts_epoch"),
+    ("client_ts", "client_id, ts_epoch"),
+)
+
+PARTITION_PREFIX = "analytics_events_"
+PARTITION_GLOB = PARTITION_PREFIX + "[0-9][0-9][0-9][0-9][0-9][0-9]"
+
+
+def partition_for(ts: str) -> str:
+    return f"{PARTITION_PREFIX}{ts[:4]}{ts[5:7]}"
+
+
+def partition_month_start(name: str) -> date:
+    suffix = name[len(PARTITION_PREFIX) :]
+    return date(int(suffix[:4]), int(suffix[4:]), 1)
+
+
+def list_partitions(conn):
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ? ORDER BY name",
+        (PARTITION_GLOB,),
+    ).fetchall()
+    return [row["name"] for row in rows]
+
+
+def ensure_partition(conn, name: str):
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT NOT NULL,
+            ts_epoch INTEGER NOT NULL,
+            event_type_id INTEGER NOT NULL,
+            client_id TEXT,
+            session_id TEXT,
+            path_id INTEGER,
+            city_input TEXT,
+            city_resolved_id INTEGER,
+            country_id INTEGER,
+            country_code_id INTEGER,
+            target_date TEXT,
+            purpose_id INTEGER,
+            link_url TEXT,
+            error_code_id INTEGER,
+            error_message TEXT,
+            load_ms REAL,
+            meta_json TEXT,
+            sample_weight INTEGER NOT NULL DEFAULT 1
+        )
+        """
+    )
+    for suffix, columns in PARTITION_INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{suffix} ON {name}({columns})")
+
+
+def decoded_events_sql(name: str) -> str:
+    columns = ["e.id"]
+    joins = []
+    for column in EVENT_COLUMNS:
+        if column in DICTIONARY_EVENT_COLUMNS:
+            columns.append(f"s_{column}.value AS {column}")
+            joins.append(
+                f"LEFT JOIN event_strings s_{column} ON s_{column}.id = e.{column}_id"
+            )
+        else:
+            columns.append(f"e.{column}")
+    return f"SELECT {', '.join(columns)} FROM {name} e {' '.join(joins)}"
+
+
+def encoded_events_sql(source: str, expressions: dict) -> str:
+    columns = [f"{source}.id"]
+    for column in EVENT_COLUMNS:
+        expression = expressions.get(column, f"{source}.{column}")
+        if column in DICTIONARY_EVENT_COLUMNS:
+            expression = f"(SELECT id FROM event_strings WHERE value = {expression})"
+        columns.append(expression)
+    return f"SELECT {', '.join(columns)} FROM {source}"
+
+
+def register_event_strings(conn, source: str):
+    for column in DICTIONARY_EVENT_COLUMNS:
+        conn.execute(
+            f"""
+            INSERT OR IGNORE INTO event_strings (value)
+            SELECT DISTINCT {column} FROM {source} WHERE {column} IS NOT NULL
+            """
+        )
+
+
+def upgrade_partitions(conn):
+    for name in list_partitions(conn):
+        columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({name})")}
+        if "event_type_id" in columns:
+            continue
+        expressions = {} if "sample_weight" in columns else {"sample_weight": "1"}
+        conn.execute("DROP VIEW IF EXISTS analytics_events")
+        conn.execute(f"ALTER TABLE {name} RENAME TO {name}_text")
+        for suffix, _ in PARTITION_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS idx_{name}_{suffix}")
+        register_event_strings(conn, f"{name}_text")
+        ensure_partition(conn, name)
+        conn.execute(
+            f"INSERT INTO {name} (id, {', '.join(STORED_EVENT_COLUMNS)}) "
+            + encoded_events_sql(f"{name}_text", expressions)
+        )
+        conn.execute(f"DROP TABLE {name}_text")
+
+
+def refresh_events_view(conn):
+    partitions = list_partitions(conn)
+    conn.execute("DROP VIEW IF EXISTS analytics_events")
+    conn.execute(
+        "CREATE VIEW analytics_events AS "
+        + " UNION ALL ".join(decoded_events_sql(name) for name in partitions)
+    )
+
+
+def migrate_legacy_events(conn):
+    legacy = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'analytics_events'"
+    ).fetchone()
+    if not legacy:
+        return
+
+    register_event_strings(conn, "analytics_events")
+    select = encoded_events_sql(
+        "analytics_events",
+        {"ts_epoch": "CAST(strftime('%s', ts) AS INTEGER)", "sample_weight": "1"},
+    )
+    months = conn.execute("SELECT DISTINCT substr(ts, 1, 7) AS month FROM analytics_events")
+    for row in months.fetchall():
+        name = partition_for(row["month"])
+        ensure_partition(conn, name)
+        conn.execute(
+            f"""
+            INSERT INTO {name} (id, {", ".join(STORED_EVENT_COLUMNS)})
+            {select}
+            WHERE substr(ts, 1, 7) = ?
+            """,
+            (row["month"],),
+        )
+    conn.execute("DROP TABLE analytics_events")
+
+
+def prune_partitions(conn, retention_days: int):
+    if retention_days <= 0:
+        return []
+
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=retention_days)
+    dropped = []
+    pruned_before = None
+    for name in list_partitions(conn):
+        month_start = partition_month_start(name)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        if next_month > cutoff:
+            break
+        conn.execute(f"DROP TABLE {name}")
+        dropped.append(name)
+        pruned_before = next_month.isoformat()
+
+    if dropped:
+        ensure_partition(conn, partition_for(utc_now_iso()))
+        refresh_events_view(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO analytics_meta (key, value) VALUES ('raw_pruned_before', ?)",
+            (pruned_before,),
+        )
+    return dropped
+
+
+def meta_value(conn, key: str):
+    row = conn.execute("SELECT value FROM analytics_meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
 def init_db():
     conn = db_connect()
     try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS event_strings (
+                id INTEGER PRIMARY KEY,
+                value TEXT NOT NULL UNIQUE
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rollup_counts (
+                day TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                key TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (metric, key, day)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rollup_client_days (
+                client_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                PRIMARY KEY (client_id, day)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rollup_perf (
+                day TEXT PRIMARY KEY,
+                samples INTEGER NOT NULL,
+                total_ms REAL NOT NULL,
+                max_ms REAL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS perf_sketches (
+                day TEXT PRIMARY KEY,
+                sketch BLOB NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS client_day_hll (
+                day TEXT PRIMARY KEY,
+                registers BLOB NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS analytics_meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
         conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS analytics_events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ts TEXT NOT NULL,
-                event_type TEXT NOT NULL,
-                client_id TEXT,
-                session_id TEXT,
-                path TEXT,
-                city_input TEXT,
-                city_resolved TEXT,
-                country TEXT,
-                country_code TEXT,
-                target_date TEXT,
-                purpose TEXT,
-                link_url TEXT,
-                error_code TEXT,
-                error_message TEXT,
-                load_ms REAL,
-                meta_json TEXT
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                city_key TEXT PRIMARY KEY,
+                location_json TEXT,
+                expires_at REAL NOT NULL,
+                location_id TEXT
             )
             """
         )
+        geocode_columns = {row["name"] for row in conn.execute("PRAGMA table_info(geocode_cache)")}
+        if "location_id" not in geocode_columns:
+            conn.execute("ALTER TABLE geocode_cache ADD COLUMN location_id TEXT")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_geocode_cache_location_id ON geocode_cache (location_id)"
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS forecast_cache (
+                grid_lat REAL NOT NULL,
+                grid_lon REAL NOT NULL,
+                run INTEGER NOT NULL,
+                days_json TEXT NOT NULL,
+                PRIMARY KEY (grid_lat, grid_lon, run)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.commit()
+
+        with conn:
+            migrate_legacy_events(conn)
+            upgrade_partitions(conn)
+            ensure_partition(conn, partition_for(utc_now_iso()))
+            refresh_events_view(conn)
+
+        version = conn.execute(
+            "SELECT value FROM analytics_meta WHERE key = 'rollups_version'"
+        ).fetchone()
+        if not version or version["value"] != ROLLUPS_VERSION:
+            with conn:
+                rebuild_rollups(conn, meta_value(conn, "raw_pruned_before") or "")
+                conn.execute(
+                    "INSERT OR REPLACE INTO analytics_meta (key, value) VALUES ('rollups_version', ?)",
+                    (ROLLUPS_VERSION,),
+                )
+        with conn:
+            prune_partitions(conn, ANALYTICS_RAW_RETENTION_DAYS)
+    finally:
+        conn.close()
+
+
+def event_row_to_dict(row):
+    return {k: row[k] for k in row.keys()}
+
+
+INSERT_EVENT_SQL = (
+    "INSERT INTO {table} ("
+    + ", ".join(STORED_EVENT_COLUMNS)
+    + ") VALUES ("
+    + ", ".join(f":{column}" for column in STORED_EVENT_COLUMNS)
+    + ")"
+)
+
+
+class EventStrings:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.conn = None
+        self.ids = {}
+
+    def lookup(self, conn, values):
+        found = {}
+        values = list(values)
+        for offset in range(0, len(values), 500):
+            chunk = values[offset : offset + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            for string_id, value in conn.execute(
+                f"SELECT id, value FROM event_strings WHERE value IN ({placeholders})", chunk
+            ):
+                found[value] = string_id
+        return found
+
+    def encode(self, conn, rows):
+        if conn is not self.conn:
+            self.conn = conn
+            self.ids = {}
+        missing = {
+            row[column] for row in rows for column in DICTIONARY_EVENT_COLUMNS
+        } - self.ids.keys()
+        missing.discard(None)
+        added = {}
+        if missing:
+            conn.executemany(
+                "INSERT OR IGNORE INTO event_strings (value) VALUES (?)",
+                [(value,) for value in missing],
+            )
+            added = self.lookup(conn, missing)
+        encoded = []
+        for row in rows:
+            item = dict(row)
+            for column in DICTIONARY_EVENT_COLUMNS:
+                value = row[column]
+                item[f"{column}_id"] = (
+                    None if value is None else self.ids.get(value) or added[value]
+                )
+            encoded.append(item)
+        return encoded, added
+
+    def remember(self, added: dict):
+        if len(self.ids) + len(added) > self.max_size:
+            self.ids = {}
+        self.ids.update(added)
+
+
+EVENT_STRINGS = EventStrings(EVENT_STRINGS_CACHE_SIZE)
+
+
+def encode_event_meta(meta):
+    if not meta:
+        return None
+    return json.dumps(meta, ensure_ascii=False, separators=(",", ":"))
+
+
+def build_event_row(event_type: str, **kwargs):
+    now = datetime.now(timezone.utc)
+    return {
+        "ts": now.isoformat(),
+        "ts_epoch": int(now.timestamp()),
+        "event_type": event_type,
+        "client_id": kwargs.get("client_id"),
+        "session_id": kwargs.get("session_id"),
+        "path": kwargs.get("path"),
+        "city_input": kwargs.get("city_input"),
+        "city_resolved": kwargs.get("city_resolved"),
+        "country": kwargs.get("country"),
+        "country_code": kwargs.get("country_code"),
+        "target_date": kwargs.get("target_date"),
+        "purpose": kwargs.get("purpose"),
+        "link_url": kwargs.get("link_url"),
+        "error_code": kwargs.get("error_code"),
+        "error_message": kwargs.get("error_message"),
+        "load_ms": kwargs.get("load_ms"),
+        "meta_json": encode_event_meta(kwargs.get("meta")),
+        "sample_weight": kwargs.get("sample_weight", 1),
+    }
+
+
+ROLLUPS_VERSION = "3"
+PERF_SKETCH_ACCURACY = 0.01
+HLL_PRECISION = 12
+
+UPSERT_ROLLUP_COUNT_SQL = """
+    INSERT INTO rollup_counts (day, metric, key, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT (metric, key, day) DO UPDATE SET count = count + excluded.count
+"""
+
+UPSERT_ROLLUP_PERF_SQL = """
+    INSERT INTO rollup_perf (day, samples, total_ms, max_ms) VALUES (?, ?, ?, ?)
+    ON CONFLICT (day) DO UPDATE SET
+        samples = samples + excluded.samples,
+        total_ms = total_ms + excluded.total_ms,
+        max_ms = MAX(max_ms, excluded.max_ms)
+"""
+
+REBUILD_ROLLUPS_SQL = (
+    "DELETE FROM rollup_counts WHERE day >= :since",
+    "DELETE FROM rollup_client_days WHERE day >= :since",
+    "DELETE FROM rollup_perf WHERE day >= :since",
+    "DELETE FROM perf_sketches WHERE day >= :since",
+    "DELETE FROM client_day_hll WHERE day >= :since",
+    """
+    INSERT INTO rollup_counts (day, metric, key, count)
+    SELECT substr(ts, 1, 10), 'event', event_type, SUM(sample_weight)
+    FROM analytics_events
+    WHERE ts >= :since
+    GROUP BY 1, 3
+    """,
+    """
+    INSERT INTO rollup_counts (day, metric, key, count)
+    SELECT substr(ts, 1, 10), 'search_date', target_date, SUM(sample_weight)
+    FROM analytics_events
+    WHERE ts >= :since AND event_type = 'weather_search' AND target_date IS NOT NULL
+    GROUP BY 1, 3
+    """,
+    """
+    INSERT INTO rollup_counts (day, metric, key, count)
+    SELECT substr(ts, 1, 10), 'search_city', city_input, SUM(sample_weight)
+    FROM analytics_events
+    WHERE ts >= :since AND event_type = 'weather_search'
+      AND city_input IS NOT NULL AND city_input != ''
+    GROUP BY 1, 3
+    """,
+    """
+    INSERT INTO rollup_counts (day, metric, key, count)
+    SELECT substr(ts, 1, 10), 'search_country', COALESCE(country, 'Unknown'), SUM(sample_weight)
+    FROM analytics_events
+    WHERE ts >= :since AND event_type = 'weather_search'
+    GROUP BY 1, 3
+    """,
+    """
+    INSERT INTO rollup_counts (day, metric, key, count)
+    SELECT substr(ts, 1, 10), 'link', link_url, SUM(sample_weight)
+    FROM analytics_events
+    WHERE ts >= :since AND event_type = 'link_click' AND link_url IS NOT NULL
+    GROUP BY 1, 3
+    """,
+    """
+    INSERT INTO rollup_counts (day, metric, key, count)
+    SELECT substr(ts, 1, 10), 'error_code', COALESCE(error_code, 'unknown'), SUM(sample_weight)
+    FROM analytics_events
+    WHERE ts >= :since AND event_type = 'error'
+    GROUP BY 1, 3
+    """,
+    """
+    INSERT INTO rollup_client_days (client_id, day)
+    SELECT DISTINCT client_id, substr(ts, 1, 10)
+    FROM analytics_events
+    WHERE ts >= :since AND client_id IS NOT NULL AND client_id != ''
+    """,
+    """
+    INSERT INTO rollup_perf (day, samples, total_ms, max_ms)
+    SELECT substr(ts, 1, 10), SUM(sample_weight), SUM(load_ms * sample_weight), MAX(load_ms)
+    FROM analytics_events
+    WHERE ts >= :since AND event_type = 'page_perf' AND load_ms IS NOT NULL
+      AND abs(load_ms) < 9e999
+    GROUP BY 1
+    """,
+)
+
+
+class QuantileSketch:
+    HEADER = struct.Struct("<Bdd")
+    BIN = struct.Struct("<hd")
+    MIN_VALUE = 1e-6
+    MAX_INDEX = 2**15 - 1
+
+    def __init__(self, relative_accuracy: float = PERF_SKETCH_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0.0
+
+    @property
+    def count(self) -> float:
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value: float, weight: float = 1.0):
+        if not math.isfinite(value):
+            return
+        if value < self.MIN_VALUE:
+            self.zero_count += weight
+            return
+        index = min(math.ceil(math.log(value) / self.log_gamma), self.MAX_INDEX)
+        self.bins[index] = self.bins.get(index, 0.0) + weight
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        self.zero_count += other.zero_count
+        for index, weight in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+
+    def quantile(self, q: float):
+        total = self.count
+        if not total:
+            return None
+        rank = min(math.floor(q * total), total - 1)
+        cumulative = self.zero_count
+        if rank < cumulative:
+            return 0.0
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if rank < cumulative:
+                return 2 * self.gamma**index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_bytes(self) -> bytes:
+        parts = [self.HEADER.pack(1, self.relative_accuracy, self.zero_count)]
+        parts.extend(self.BIN.pack(index, weight) for index, weight in sorted(self.bins.items()))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "QuantileSketch":
+        _, relative_accuracy, zero_count = cls.HEADER.unpack_from(data)
+        sketch = cls(relative_accuracy)
+        sketch.zero_count = zero_count
+        for index, weight in cls.BIN.iter_unpack(data[cls.HEADER.size :]):
+            sketch.bins[index] = weight
+        return sketch
+
+
+class HyperLogLog:
+    POWERS = [2.0**-rank for rank in range(65)]
+
+    def __init__(self, precision: int = HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+
+    def add(self, value: str):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+        hashed = int.from_bytes(digest, "big")
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def union(self, other: "HyperLogLog") -> "HyperLogLog":
+        return HyperLogLog(self.precision, bytes(map(max, self.registers, other.registers)))
+
+    def estimate(self) -> float:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        harmonic = sum(self.POWERS[rank] for rank in self.registers)
+        estimate = alpha * self.size * self.size / harmonic
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)
+        return estimate
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        registers = zlib.decompress(data)
+        return cls(int(math.log2(len(registers))), registers)
+
+
+def merge_client_sketches(conn, sketches: dict):
+    for day, sketch in sketches.items():
+        row = conn.execute("SELECT registers FROM client_day_hll WHERE day = ?", (day,)).fetchone()
+        if row:
+            sketch = sketch.union(HyperLogLog.from_bytes(row["registers"]))
+        conn.execute(
+            "INSERT OR REPLACE INTO client_day_hll (day, registers) VALUES (?, ?)",
+            (day, sketch.to_bytes()),
+        )
+
+
+def merge_perf_sketches(conn, sketches: dict):
+    for day, sketch in sketches.items():
+        row = conn.execute("SELECT sketch FROM perf_sketches WHERE day = ?", (day,)).fetchone()
+        if row:
+            stored = QuantileSketch.from_bytes(row["sketch"])
+            stored.merge(sketch)
+            sketch = stored
         conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_analytics_ts ON analytics_events(ts)"
+            "INSERT OR REPLACE INTO perf_sketches (day, sketch) VALUES (?, ?)",
+            (day, sketch.to_bytes()),
+        )
+
+
+def rebuild_rollups(conn, since: str = ""):
+    for sql in REBUILD_ROLLUPS_SQL:
+        conn.execute(sql, {"since": since})
+
+    sketches = {}
+    for row in conn.execute(
+        """
+        SELECT substr(ts, 1, 10) AS day, load_ms, sample_weight
+        FROM analytics_events
+        WHERE ts >= ? AND event_type = 'page_perf' AND load_ms IS NOT NULL
+        """,
+        (since,),
+    ):
+        sketches.setdefault(row["day"], QuantileSketch()).add(row["load_ms"], row["sample_weight"])
+    merge_perf_sketches(conn, sketches)
+
+    client_sketches = {}
+    for row in conn.execute(
+        "SELECT client_id, day FROM rollup_client_days WHERE day >= ?", (since,)
+    ):
+        client_sketches.setdefault(row["day"], HyperLogLog()).add(row["client_id"])
+    merge_client_sketches(conn, client_sketches)
+
+
+def apply_rollups(conn, rows):
+    counts = Counter()
+    client_days = set()
+    perf = {}
+    sketches = {}
+    client_sketches = {}
+    for row in rows:
+        day = row["ts"][:10]
+        event_type = row["event_type"]
+        weight = row["sample_weight"]
+        counts[(day, "event", event_type)] += weight
+        if event_type == "weather_search":
+            if row["target_date"] is not None:
+                counts[(day, "search_date", row["target_date"])] += weight
+            if row["city_input"]:
+                counts[(day, "search_city", row["city_input"])] += weight
+            country = row["country"] if row["country"] is not None else "Unknown"
+            counts[(day, "search_country", country)] += weight
+        elif event_type == "link_click" and row["link_url"] is not None:
+            counts[(day, "link", row["link_url"])] += weight
+        elif event_type == "error":
+            code = row["error_code"] if row["error_code"] is not None else "unknown"
+            counts[(day, "error_code", code)] += weight
+        elif event_type == "page_perf" and row["load_ms"] is not None:
+            try:
+                load_ms = float(row["load_ms"])
+            except (TypeError, ValueError):
+                continue
+            if not math.isfinite(load_ms):
+                continue
+            samples, total_ms, max_ms = perf.get(day, (0, 0.0, load_ms))
+            perf[day] = (samples + weight, total_ms + load_ms * weight, max(max_ms, load_ms))
+            sketches.setdefault(day, QuantileSketch()).add(load_ms, weight)
+        if row["client_id"]:
+            if (row["client_id"], day) not in client_days:
+                client_days.add((row["client_id"], day))
+                client_sketches.setdefault(day, HyperLogLog()).add(row["client_id"])
+
+    conn.executemany(
+        UPSERT_ROLLUP_COUNT_SQL,
+        [(day, metric, key, count) for (day, metric, key), count in counts.items()],
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO rollup_client_days (client_id, day) VALUES (?, ?)",
+        client_days,
+    )
+    conn.executemany(
+        UPSERT_ROLLUP_PERF_SQL,
+        [(day, *values) for day, values in perf.items()],
+    )
+    merge_perf_sketches(conn, sketches)
+    merge_client_sketches(conn, client_sketches)
+
+
+class AnalyticsWriter:
+    POLICIES = ("block", "drop_oldest", "drop")
+    STOP = object()
+
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float, policy: str):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown analytics queue policy: {policy}")
+        self.queue = queue.Queue()
+        self.max_queue = max_queue
+        self.pending = 0
+        self.space = threading.Condition()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counters = {"written": 0, "batches": 0, "dropped": 0, "failed": 0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="analytics-writer", daemon=True)
+            self.thread.start()
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def submit(self, rows: list):
+        self.start()
+        dropped = 0
+        with self.space:
+            if self.policy == "block":
+                while self.pending and self.pending + len(rows) > self.max_queue:
+                    self.space.wait()
+            elif self.policy == "drop_oldest":
+                while self.pending and self.pending + len(rows) > self.max_queue:
+                    oldest = self.queue.get_nowait()
+                    self.queue.task_done()
+                    if oldest is self.STOP:
+                        self.queue.put_nowait(oldest)
+                        continue
+                    self.pending -= len(oldest)
+                    dropped += len(oldest)
+            elif self.pending and self.pending + len(rows) > self.max_queue:
+                dropped, rows = len(rows), None
+            if rows is not None:
+                self.pending += len(rows)
+                self.queue.put_nowait(rows)
+        if dropped:
+            self.count("dropped", dropped)
+
+    def take(self, timeout=None):
+        item = self.queue.get(timeout=timeout)
+        if item is not self.STOP:
+            with self.space:
+                self.pending -= len(item)
+                self.space.notify_all()
+        return item
+
+    def collect(self):
+        batch = [self.take()]
+        size = len(batch[-1]) if batch[-1] is not self.STOP else 0
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not self.STOP and size < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.take(remaining))
+            except queue.Empty:
+                break
+            if batch[-1] is not self.STOP:
+                size += len(batch[-1])
+        return batch
+
+    def run(self):
+        conn = db_connect()
+        partitions = set(list_partitions(conn))
+        next_prune = time.monotonic() + ANALYTICS_PRUNE_INTERVAL
+        try:
+            while True:
+                if ANALYTICS_RAW_RETENTION_DAYS > 0 and time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + ANALYTICS_PRUNE_INTERVAL
+                    try:
+                        with conn:
+                            dropped = prune_partitions(conn, ANALYTICS_RAW_RETENTION_DAYS)
+                        partitions.difference_update(dropped)
+                    except Exception as error:
+                        conn.rollback()
+                        print(f"Analytics partition pruning failed: {error}", file=sys.stderr)
+                batch = self.collect()
+                stop = batch[-1] is self.STOP
+                rows = [row for item in batch if item is not self.STOP for row in item]
+                try:
+                    if rows:
+                        self.write_isolating(conn, rows, partitions)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def write_isolating(self, conn, rows, partitions):
+        try:
+            self.write(conn, rows, partitions)
+        except Exception as error:
+            conn.rollback()
+            if len(rows) == 1:
+                self.count("failed")
+                print(f"Analytics write failed: {error}", file=sys.stderr)
+                return
+            middle = len(rows) // 2
+            self.write_isolating(conn, rows[:middle], partitions)
+            self.write_isolating(conn, rows[middle:], partitions)
+
+    def write(self, conn, rows, partitions=None):
+        started = time.perf_counter()
+        created = []
+        with conn:
+            encoded, added = EVENT_STRINGS.encode(conn, rows)
+            by_partition = {}
+            for row in encoded:
+                by_partition.setdefault(partition_for(row["ts"]), []).append(row)
+            for name, partition_rows in by_partition.items():
+                if partitions is None or name not in partitions:
+                    ensure_partition(conn, name)
+                    refresh_events_view(conn)
+                    created.append(name)
+                conn.executemany(INSERT_EVENT_SQL.format(table=name), partition_rows)
+            apply_rollups(conn, rows)
+        EVENT_STRINGS.remember(added)
+        if partitions is not None:
+            partitions.update(created)
+        self.count("written", len(rows))
+        self.count("batches")
+        METRICS.observe(
+            "weather_stage_duration_seconds", time.perf_counter() - started, stage="db_write"
+        )
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self, timeout: float = 10.0):
+        with self.lock:
+            thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(self.STOP)
+        thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["queued"] = self.pending
+        stats["policy"] = self.policy
+        return stats
+
+
+ANALYTICS_WRITER = AnalyticsWriter(
+    ANALYTICS_QUEUE_SIZE, ANALYTICS_BATCH_SIZE, ANALYTICS_FLUSH_INTERVAL, ANALYTICS_QUEUE_POLICY
+)
+
+
+def send_frame(sock, payload):
+    body = encode_json(payload)
+    sock.sendall(struct.pack("!I", len(body)) + body)
+
+
+def read_frames(sock):
+    with sock.makefile("rb") as reader:
+        while True:
+            header = reader.read(4)
+            if len(header) < 4:
+                return
+            (size,) = struct.unpack("!I", header)
+            body = reader.read(size)
+            if len(body) < size:
+                return
+            yield json.loads(body)
+
+
+class AnalyticsForwarder(AnalyticsWriter):
+    def __init__(self, path: str, max_queue: int, batch_size: int, flush_interval: float, policy: str):
+        super().__init__(max_queue, batch_size, flush_interval, policy)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def run(self):
+        sock = None
+        try:
+            while True:
+                batch = self.collect()
+                stop = batch[-1] is self.STOP
+                rows = [row for item in batch if item is not self.STOP for row in item]
+                try:
+                    if rows:
+                        if sock is None:
+                            sock = self.connect()
+                        send_frame(sock, rows)
+                        self.count("written", len(rows))
+                        self.count("batches")
+                except OSError as error:
+                    if sock is not None:
+                        sock.close()
+                        sock = None
+                    self.count("failed", len(rows))
+                    print(f"Analytics forwarding failed: {error}", file=sys.stderr)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if stop:
+                    return
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def stats(self):
+        stats = super().stats()
+        stats["writer"] = self.path
+        return stats
+
+
+def log_event(event_type: str, **kwargs):
+    ANALYTICS_WRITER.submit([build_event_row(event_type, **kwargs)])
+
+
+def log_events(rows):
+    ANALYTICS_WRITER.submit(rows)
+
+
+def parse_track_body(raw_body: bytes):
+    text = raw_body.decode("utf-8").strip() or "{}"
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, list):
+        return data, True
+    return [data], False
+
+
+def track_text(data: dict, key: str):
+    value = data.get(key)
+    if not isinstance(value, str):
+        return None
+    return value.strip() or None
+
+
+def is_finite_number(value) -> bool:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+def track_event_error(data: dict):
+    if not track_text(data, "eventType"):
+        return "eventType is required"
+    if data.get("loadMs") is not None and not is_finite_number(data["loadMs"]):
+        return "loadMs must be a finite number"
+    return None
+
+
+def track_event_row(data: dict):
+    event_type = track_text(data, "eventType")
+    if not event_type:
+        return None
+    return build_event_row(
+        event_type,
+        client_id=track_text(data, "clientId"),
+        session_id=track_text(data, "sessionId"),
+        path=track_text(data, "path"),
+        city_input=track_text(data, "cityInput"),
+        city_resolved=track_text(data, "cityResolved"),
+        country=track_text(data, "country"),
+        country_code=track_text(data, "countryCode"),
+        target_date=track_text(data, "targetDate"),
+        purpose=track_text(data, "purpose"),
+        link_url=track_text(data, "linkUrl"),
+        error_code=track_text(data, "errorCode"),
+        error_message=track_text(data, "errorMessage"),
+        load_ms=None if data.get("loadMs") is None else float(data["loadMs"]),
+        meta=data.get("meta") or {},
+    )
+
+
+def parse_sampling(value: str):
+    sampling = {}
+    for item in value.split(","):
+        event_type, _, every = item.partition("=")
+        if event_type.strip() and every.strip():
+            sampling[event_type.strip()] = max(1, int(every))
+    return sampling
+
+
+class IngestGuard:
+    def __init__(self, rate: float, burst: int, max_clients: int, sampling: dict):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.sampling = sampling
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            "tooLarge": 0,
+            "rateLimited": 0,
+            "sampledIn": 0,
+            "sampledOut": 0,
+        }
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def allow(self, wanted: Counter) -> dict:
+        if self.rate <= 0:
+            return dict(wanted)
+        now = time.monotonic()
+        allowed = {}
+        with self.lock:
+            for client_id, count in wanted.items():
+                if client_id is None:
+                    allowed[client_id] = count
+                    continue
+                tokens, updated = self.buckets.pop(client_id, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                allowed[client_id] = min(count, int(tokens))
+                self.buckets[client_id] = (tokens - allowed[client_id], now)
+                self.counters["rateLimited"] += count - allowed[client_id]
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return allowed
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(1 / self.rate)) if self.rate > 0 else 1
+
+    def sample(self, row) -> bool:
+        every = self.sampling.get(row["event_type"], 1)
+        if every == 1:
+            return True
+        if random.random() * every >= 1:
+            self.count("sampledOut")
+            return False
+        self.count("sampledIn")
+        row["sample_weight"] = every
+        return True
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            clients = len(self.buckets)
+        return {
+            **counters,
+            "clients": clients,
+            "rate": self.rate,
+            "burst": self.burst,
+            "sampling": self.sampling,
+            "maxBodyBytes": MAX_REQUEST_BODY_BYTES,
+        }
+
+
+INGEST_GUARD = IngestGuard(
+    TRACK_RATE_LIMIT, TRACK_RATE_BURST, TRACK_RATE_MAX_CLIENTS, parse_sampling(TRACK_SAMPLING)
+)
+
+
+def request_body_error(content_length):
+    try:
+        size = int(content_length or 0)
+    except ValueError:
+        size = -1
+    if size < 0:
+        return json_response(400, {"error": "Invalid Content-Length"})
+    if size > MAX_REQUEST_BODY_BYTES:
+        INGEST_GUARD.count("tooLarge")
+        return json_response(
+            413, {"error": f"Request body too large, max {MAX_REQUEST_BODY_BYTES} bytes"}
+        )
+    return None
+
+
+def query_rows(sql: str, params=()):
+    with READ_POOL.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+        return [event_row_to_dict(r) for r in rows]
+
+
+def query_one(sql: str, params=()):
+    with READ_POOL.connection() as conn:
+        row = conn.execute(sql, params).fetchone()
+        return event_row_to_dict(row) if row else None
+
+
+def normalize_city(city: str) -> str:
+    return " ".join(city.casefold().split())
+
+
+def location_id_for(lat, lon) -> str:
+    return hashlib.sha1(f"{float(lat):.4f},{float(lon):.4f}".encode("ascii")).hexdigest()[:12]
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return entry
+
+    def set(self, key, value, ttl: float):
+        with self.lock:
+            self.items[key] = (time.time() + ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class GeocodeCache:
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.memory = LRUCache(max_size)
+        self.by_id = LRUCache(max_size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.counters = {"memoryHits": 0, "dbHits": 0, "negativeHits": 0, "misses": 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get(self, key: str, memory_only: bool = False):
+        entry = self.memory.get(key)
+        if entry is None:
+            if memory_only:
+                return None
+            entry = self.load(key)
+            if entry is not None:
+                self.memory.set(key, entry[1], entry[0] - time.time())
+                if entry[1] is not None:
+                    self.by_id.set(
+                        location_id_for(entry[1]["lat"], entry[1]["lon"]),
+                        entry[1],
+                        entry[0] - time.time(),
+                    )
+                self.count("dbHits")
+        else:
+            self.count("memoryHits")
+
+        if entry is None:
+            self.count("misses")
+            return False, None
+        if entry[1] is None:
+            self.count("negativeHits")
+        return True, entry[1]
+
+    def get_by_id(self, location_id: str, memory_only: bool = False):
+        entry = self.by_id.get(location_id)
+        if entry is not None:
+            self.count("memoryHits")
+            return entry[1]
+        if memory_only:
+            return None
+
+        row = query_one(
+            """
+            SELECT location_json, expires_at FROM geocode_cache
+            WHERE location_id = ? AND expires_at > ? AND location_json IS NOT NULL
+            LIMIT 1
+            """,
+            (location_id, time.time()),
+        )
+        if not row:
+            self.count("misses")
+            return None
+        location = json.loads(row["location_json"])
+        self.by_id.set(location_id, location, row["expires_at"] - time.time())
+        self.count("dbHits")
+        return location
+
+    def set(self, key: str, location):
+        ttl = self.ttl if location is not None else self.negative_ttl
+        location_id = None
+        self.memory.set(key, location, ttl)
+        if location is not None:
+            location_id = location_id_for(location["lat"], location["lon"])
+            self.by_id.set(location_id, location, ttl)
+        with WRITE_POOL.connection() as conn, conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO geocode_cache (city_key, location_json, expires_at, location_id)
+                VALUES (?, ?, ?, ?)
+                """,
+                (
+                    key,
+                    json.dumps(location, ensure_ascii=False) if location is not None else None,
+                    time.time() + ttl,
+                    location_id,
+                ),
+            )
+
+    def load(self, key: str):
+        row = query_one(
+            "SELECT location_json, expires_at FROM geocode_cache WHERE city_key = ? AND expires_at > ?",
+            (key, time.time()),
+        )
+        if not row:
+            return None
+        location = json.loads(row["location_json"]) if row["location_json"] else None
+        return row["expires_at"], location
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        hits = stats["memoryHits"] + stats["dbHits"]
+        lookups = hits + stats["misses"]
+        stats["size"] = len(self.memory)
+        stats["hitRate"] = round((hits / lookups) * 100, 2) if lookups else 0
+        return stats
+
+
+GEOCODE_CACHE = GeocodeCache(GEOCODE_CACHE_SIZE, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_TTL)
+
+
+def fold_text(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.replace("-", " ").split())
+
+
+def load_gazetteer(path: str):
+    if not os.path.exists(path):
+        return []
+    locations = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            name, country, country_code, lat, lon = fields[:5]
+            try:
+                float(lat), float(lon)
+                population = int(fields[5]) if len(fields) > 5 and fields[5] else 0
+            except ValueError:
+                continue
+            locations.append(
+                (
+                    {
+                        "lat": lat,
+                        "lon": lon,
+                        "resolved_city": name,
+                        "country": country or None,
+                        "country_code": country_code.upper(),
+                    },
+                    population,
+                )
+            )
+    return locations
+
+
+class CityIndex:
+    def __init__(self, gazetteer_path: str, ttl: float):
+        self.gazetteer_path = gazetteer_path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.current = None
+        self.refreshing = False
+        self.gazetteer = None
+        self.counters = {"builds": 0, "queries": 0}
+
+    def build(self):
+        if self.gazetteer is None:
+            self.gazetteer = load_gazetteer(self.gazetteer_path)
+        searches = Counter()
+        for row in rollup_top("search_city", "city"):
+            searches[normalize_city(row["city"])] += row["count"]
+
+        locations = {}
+        ranks = {}
+
+        def add(location, searched: int, population: int):
+            location_id = location_id_for(location["lat"], location["lon"])
+            if location_id not in locations:
+                locations[location_id] = location
+                ranks[location_id] = [0, 0, fold_text(location["resolved_city"])]
+            ranks[location_id][0] -= searched
+            ranks[location_id][1] = min(ranks[location_id][1], -population)
+
+        rows = query_rows(
+            """
+            SELECT city_key, location_json FROM geocode_cache
+            WHERE location_json IS NOT NULL AND expires_at > ?
+            """,
+            (time.time(),),
+        )
+        for row in rows:
+            location = json.loads(row["location_json"])
+            if location.get("resolved_city"):
+                add(location, searches[row["city_key"]], 0)
+        for location, population in self.gazetteer:
+            add(location, 0, population)
+
+        entries = []
+        for location_id, rank in ranks.items():
+            name = rank[2]
+            for position in range(len(name)):
+                if position == 0 or name[position - 1] == " ":
+                    entries.append((name[position:], location_id))
+        entries.sort()
+        return {
+            "keys": [key for key, _ in entries],
+            "ids": [location_id for _, location_id in entries],
+            "locations": locations,
+            "ranks": {location_id: tuple(rank) for location_id, rank in ranks.items()},
+            "built_at": time.monotonic(),
+        }
+
+    def load(self):
+        with self.build_lock:
+            index = self.build()
+            self.current = index
+        with self.lock:
+            self.counters["builds"] += 1
+        return index
+
+    def index(self):
+        index = self.current
+        if index is None:
+            return self.load()
+        if time.monotonic() - index["built_at"] > self.ttl:
+            self.refresh_in_background()
+        return index
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.load()
+            except Exception as error:
+                print(f"City index rebuild failed: {error}", file=sys.stderr)
+            finally:
+                with self.lock:
+                    self.refreshing = False
+
+        threading.Thread(target=run, name="city-index", daemon=True).start()
+
+    def suggest(self, query: str, limit: int):
+        with self.lock:
+            self.counters["queries"] += 1
+        prefix = fold_text(query)
+        if not prefix:
+            return []
+        index = self.index()
+        keys = index["keys"]
+        found = {}
+        position = bisect.bisect_left(keys, prefix)
+        while (
+            position < len(keys)
+            and keys[position].startswith(prefix)
+            and len(found) < CITY_SUGGEST_SCAN_LIMIT
+        ):
+            found.setdefault(index["ids"][position])
+            position += 1
+        ranked = sorted(found, key=index["ranks"].__getitem__)[:limit]
+        return [(location_id, index["locations"][location_id]) for location_id in ranked]
+
+    def get_by_id(self, location_id: str):
+        return self.index()["locations"].get(location_id)
+
+    def stats(self):
+        index = self.current
+        with self.lock:
+            stats = dict(self.counters)
+        stats["cities"] = len(index["locations"]) if index else 0
+        stats["keys"] = len(index["keys"]) if index else 0
+        return stats
+
+
+CITY_INDEX = CityIndex(CITY_GAZETTEER_PATH, CITY_INDEX_TTL)
+
+
+def forecast_grid_point(lat, lon):
+    def snap(value):
+        return round(round(float(value) / FORECAST_GRID_DEG) * FORECAST_GRID_DEG, 4)
+
+    return snap(lat), snap(lon)
+
+
+def forecast_run(now=None) -> int:
+    now = time.time() if now is None else now
+    return int(now // FORECAST_RUN_INTERVAL) * FORECAST_RUN_INTERVAL
+
+
+def parse_daily_forecast(daily: dict):
+    days = {}
+    for index, day in enumerate(daily.get("time") or []):
+        values = {}
+        for field in FORECAST_DAILY_FIELDS:
+            column = daily.get(field)
+            values[field] = column[index] if isinstance(column, list) and index < len(column) else None
+        days[day] = values
+    return days
+
+
+class ForecastCache:
+    def __init__(self, max_size: int, shared: bool = False):
+        self.memory = LRUCache(max_size)
+        self.latest = LRUCache(max_size)
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "sharedHits": 0, "staleHits": 0}
+
+    def get(self, key, memory_only: bool = False):
+        entry = self.memory.get(key)
+        days = entry[1] if entry is not None else None
+        from_shared = False
+        if days is None and self.shared:
+            if memory_only:
+                return None
+            days = self.load(key)
+            if days is not None:
+                from_shared = True
+                self.memory.set(key, days, key[2] + FORECAST_RUN_INTERVAL - time.time())
+        with self.lock:
+            self.counters["hits" if days is not None else "misses"] += 1
+            if from_shared:
+                self.counters["sharedHits"] += 1
+        return days
+
+    def get_stale(self, point):
+        entry = self.latest.get(point)
+        stale = entry[1] if entry is not None else None
+        if stale is None and self.shared:
+            stale = self.load_latest(point)
+        if stale is None:
+            return None
+        with self.lock:
+            self.counters["staleHits"] += 1
+        return stale
+
+    async def get_async(self, key):
+        days = self.get(key, memory_only=True)
+        if days is None and self.shared:
+            days = await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+        return days
+
+    def set(self, key, days: dict, run: int, persist: bool = True):
+        self.memory.set(key, days, run + FORECAST_RUN_INTERVAL - time.time())
+        self.latest.set(key[:2], (run, days), FORECAST_STALE_TTL)
+        if self.shared and persist:
+            self.store(key, days)
+
+    async def set_async(self, key, days: dict, run: int):
+        self.set(key, days, run, persist=False)
+        if self.shared:
+            await asyncio.get_running_loop().run_in_executor(None, self.store, key, days)
+
+    def store(self, key, days: dict):
+        with WRITE_POOL.connection() as conn, conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO forecast_cache (grid_lat, grid_lon, run, days_json)
+                VALUES (?, ?, ?, ?)
+                """,
+                (*key, json.dumps(days, ensure_ascii=False)),
+            )
+            conn.execute(
+                "DELETE FROM forecast_cache WHERE run < ?", (time.time() - FORECAST_STALE_TTL,)
+            )
+
+    def load(self, key):
+        if key[2] + FORECAST_RUN_INTERVAL <= time.time():
+            return None
+        row = query_one(
+            "SELECT days_json FROM forecast_cache WHERE grid_lat = ? AND grid_lon = ? AND run = ?",
+            key,
+        )
+        return json.loads(row["days_json"]) if row else None
+
+    def load_latest(self, point):
+        row = query_one(
+            """
+            SELECT run, days_json FROM forecast_cache
+            WHERE grid_lat = ? AND grid_lon = ? AND run >= ?
+            ORDER BY run DESC
+            LIMIT 1
+            """,
+            (*point, time.time() - FORECAST_STALE_TTL),
+        )
+        if not row:
+            return None
+        stale = (row["run"], json.loads(row["days_json"]))
+        self.latest.set(point, stale, row["run"] + FORECAST_STALE_TTL - time.time())
+        return stale
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["size"] = len(self.memory)
+        stats["hitRate"] = round((stats["hits"] / lookups) * 100, 2) if lookups else 0
+        return stats
+
+
+FORECAST_CACHE = ForecastCache(FORECAST_CACHE_SIZE, shared=SERVER_WORKERS > 1)
+WEATHER_BODY_CACHE = LRUCache(FORECAST_CACHE_SIZE)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+        self.counters = {"leaders": 0, "deduplicated": 0}
+
+    def do(self, key, fn, deadline=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event(), "result": None, "error": None}
+                self.counters["leaders"] += 1
+            else:
+                self.counters["deduplicated"] += 1
+
+        if not leader:
+            if not call["done"].wait(deadline.timeout() if deadline else None):
+                raise DeadlineExceeded()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as error:
+            call["error"] = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+    async def do_async(self, key, fn, deadline=None):
+        future = self.async_calls.get(key)
+        if future is not None:
+            with self.lock:
+                self.counters["deduplicated"] += 1
+            if deadline is None:
+                return await asyncio.shield(future)
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), deadline.timeout())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded() from None
+
+        future = self.async_calls[key] = asyncio.get_running_loop().create_future()
+        with self.lock:
+            self.counters["leaders"] += 1
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            future.exception()
+            raise
+        finally:
+            del self.async_calls[key]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["inFlight"] = len(self.calls) + len(self.async_calls)
+        return stats
+
+
+UPSTREAM_FLIGHTS = SingleFlight()
+
+
+class UpstreamError(Exception):
+    def __init__(self, message: str, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class DeadlineExceeded(UpstreamError):
+    def __init__(self):
+        super().__init__("Превышено время ожидания ответа", 504)
+
+
+class Deadline:
+    def __init__(self, budget: float):
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def stage(self, share: float):
+        return Deadline(max(0.0, self.remaining()) * share)
+
+    def timeout(self, limit=None) -> float:
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return remaining if limit is None else min(limit, remaining)
+
+
+class CircuitOpen(UpstreamError):
+    def __init__(self, name: str):
+        super().__init__(f"Сервис {name} временно недоступен", 503)
+
+
+def is_upstream_failure(error) -> bool:
+    if isinstance(error, CircuitOpen):
+        return False
+    if isinstance(error, UpstreamError):
+        return error.status is None or error.status >= 500 or error.status == 429
+    return isinstance(error, (OSError, EOFError, http.client.HTTPException, ValueError))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, window: float, min_requests: int, error_rate: float, cooldown: float):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.outcomes = deque()
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self.probe_started = 0.0
+        self.counters = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def trim(self, now: float):
+        while self.outcomes and self.outcomes[0][0] <= now - self.window:
+            self.outcomes.popleft()
+
+    def allow(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.state == "open" and now - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open" and self.probing and now - self.probe_started >= self.cooldown:
+                self.probing = False
+            if self.state == "closed":
+                return
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                self.probe_started = now
+                return
+            self.counters["rejected"] += 1
+        raise CircuitOpen(self.name)
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        with self.lock:
+            self.counters["successes" if ok else "failures"] += 1
+            if self.state == "half_open":
+                self.probing = False
+                if ok:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                else:
+                    self.open(now)
+                return
+            self.outcomes.append((now, ok))
+            self.trim(now)
+            failures = sum(1 for _, outcome in self.outcomes if not outcome)
+            if (
+                self.state == "closed"
+                and len(self.outcomes) >= self.min_requests
+                and failures / len(self.outcomes) >= self.error_rate
+            ):
+                self.open(now)
+
+    def open(self, now: float):
+        self.state = "open"
+        self.opened_at = now
+        self.outcomes.clear()
+        self.counters["opened"] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            self.trim(now)
+            stats = dict(self.counters)
+            stats["state"] = self.state
+            failures = sum(1 for _, outcome in self.outcomes if not outcome)
+            stats["errorRate"] = (
+                round((failures / len(self.outcomes)) * 100, 2) if self.outcomes else 0
+            )
+            if self.state == "open":
+                stats["retryIn"] = round(max(0.0, self.cooldown - (now - self.opened_at)), 2)
+        return stats
+
+
+class RetryBudget:
+    def __init__(self, ratio: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+        self.counters = {"retries": 0, "exhausted": 0}
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                self.counters["exhausted"] += 1
+                return False
+            self.tokens -= 1
+            self.counters["retries"] += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["tokens"] = round(self.tokens, 2)
+        return stats
+
+
+class UpstreamGuard:
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = CircuitBreaker(
+            name,
+            UPSTREAM_BREAKER_WINDOW,
+            UPSTREAM_BREAKER_MIN_REQUESTS,
+            UPSTREAM_BREAKER_ERROR_RATE,
+            UPSTREAM_BREAKER_COOLDOWN,
+        )
+        self.retries = RetryBudget(UPSTREAM_RETRY_RATIO, UPSTREAM_RETRY_BUDGET_MAX)
+
+    def backoff(self, attempt: int, deadline=None):
+        if attempt >= UPSTREAM_MAX_RETRIES:
+            return None
+        delay = random.uniform(0, min(UPSTREAM_RETRY_BACKOFF_MAX, UPSTREAM_RETRY_BACKOFF * 2**attempt))
+        if deadline and deadline.remaining() <= delay:
+            return None
+        if not self.retries.withdraw():
+            return None
+        return delay
+
+    def call(self, fn, deadline=None):
+        self.retries.deposit()
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            try:
+                result = fn()
+            except Exception as error:
+                if not is_upstream_failure(error):
+                    self.breaker.record(True)
+                    raise
+                self.breaker.record(False)
+                delay = self.backoff(attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.breaker.record(True)
+            return result
+
+    async def call_async(self, fn, deadline=None):
+        self.retries.deposit()
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            try:
+                result = await fn()
+            except Exception as error:
+                if not is_upstream_failure(error):
+                    self.breaker.record(True)
+                    raise
+                self.breaker.record(False)
+                delay = self.backoff(attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record(True)
+            return result
+
+    def stats(self):
+        return {**self.breaker.stats(), "retryBudget": self.retries.stats()}
+
+
+UPSTREAM_GUARDS = {
+    urlparse(NOMINATIM_BASE_URL).netloc: UpstreamGuard("nominatim"),
+    urlparse(OPEN_METEO_BASE_URL).netloc: UpstreamGuard("open_meteo"),
+}
+
+
+def upstream_guard(url: str) -> UpstreamGuard:
+    netloc = urlparse(url).netloc
+    guard = UPSTREAM_GUARDS.get(netloc)
+    if guard is None:
+        guard = UPSTREAM_GUARDS.setdefault(netloc, UpstreamGuard(netloc))
+    return guard
+
+
+def breaker_stats():
+    return {guard.name: guard.stats() for guard in list(UPSTREAM_GUARDS.values())}
+
+
+class ConnectionPool:
+    def __init__(self, max_connections: int, timeouts=None, default_timeouts=(3.0, 10.0)):
+        self.max_connections = max_connections
+        self.timeouts = timeouts or {}
+        self.default_timeouts = default_timeouts
+        self.ssl_context = ssl.create_default_context()
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.counters = {"created": 0, "reused": 0, "retried": 0}
+
+    def host_state(self, origin):
+        with self.lock:
+            state = self.hosts.get(origin)
+            if state is None:
+                state = self.hosts[origin] = {
+                    "idle": [],
+                    "slots": threading.BoundedSemaphore(self.max_connections),
+                }
+            return state
+
+    def checkout(self, origin, state, connect_timeout: float):
+        with self.lock:
+            if state["idle"]:
+                self.counters["reused"] += 1
+                return state["idle"].pop(), True
+            self.counters["created"] += 1
+
+        scheme, host, port = origin
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                host, port, timeout=connect_timeout, context=self.ssl_context
+            )
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=connect_timeout)
+        conn.connect()
+        return conn, False
+
+    def checkin(self, state, conn):
+        with self.lock:
+            if len(state["idle"]) < self.max_connections:
+                state["idle"].append(conn)
+                return
+        conn.close()
+
+    def request(self, url: str, headers=None, deadline=None):
+        parsed = urlparse(url)
+        origin = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+        request_headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive", **(headers or {})}
+
+        def bounded(limit: float) -> float:
+            return deadline.timeout(limit) if deadline else limit
+
+        state = self.host_state(origin)
+        connect_timeout, read_timeout = self.timeouts.get(parsed.hostname, self.default_timeouts)
+        if not state["slots"].acquire(timeout=bounded(connect_timeout)):
+            if deadline and deadline.remaining() <= 0:
+                raise DeadlineExceeded()
+            raise UpstreamError(f"Нет свободных соединений к {parsed.hostname}")
+        try:
+            for attempt in range(2):
+                conn, reused = self.checkout(origin, state, bounded(connect_timeout))
+                try:
+                    conn.sock.settimeout(bounded(read_timeout))
+                    conn.request("GET", path, headers=request_headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except TimeoutError:
+                    conn.close()
+                    if deadline and deadline.remaining() <= 0:
+                        raise DeadlineExceeded() from None
+                    raise
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if reused and attempt == 0:
+                        with self.lock:
+                            self.counters["retried"] += 1
+                        continue
+                    raise
+                except Exception:
+                    conn.close()
+                    raise
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.checkin(state, conn)
+                break
+        finally:
+            state["slots"].release()
+
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            body = gzip.decompress(body)
+        if response.status >= 400:
+            raise UpstreamError(f"HTTP Error {response.status}: {response.reason}", response.status)
+        return body
+
+    def get_json(self, url: str, headers=None, deadline=None):
+        return upstream_guard(url).call(
+            lambda: json.loads(self.request(url, headers, deadline).decode("utf-8")), deadline
+        )
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["idle"] = sum(len(state["idle"]) for state in self.hosts.values())
+        return stats
+
+
+UPSTREAM_POOL = ConnectionPool(
+    UPSTREAM_MAX_CONNECTIONS,
+    timeouts={
+        urlparse(NOMINATIM_BASE_URL).hostname: (NOMINATIM_CONNECT_TIMEOUT, NOMINATIM_READ_TIMEOUT),
+        urlparse(OPEN_METEO_BASE_URL).hostname: (OPEN_METEO_CONNECT_TIMEOUT, OPEN_METEO_READ_TIMEOUT),
+    },
+)
+
+
+GEOCODE_HEADERS = {
+    "User-Agent": "simple-weather-app-analytics/1.0",
+    "Accept-Language": "ru",
+}
+
+
+def geocode_url(city: str) -> str:
+    city_q = quote(city, safe="", encoding="utf-8", errors="strict")
+    return f"{NOMINATIM_BASE_URL}/search?q={city_q}&format=json&limit=1&addressdetails=1"
+
+
+def parse_geocode_response(data, city: str):
+    if not data:
+        return None
+
+    first = data[0]
+    address = first.get("address") or {}
+    resolved_city = (
+        address.get("city")
+        or address.get("town")
+        or address.get("village")
+        or first.get("display_name", city).split(",")[0].strip()
+    )
+    return {
+        "lat": first["lat"],
+        "lon": first["lon"],
+        "resolved_city": resolved_city,
+        "country": address.get("country"),
+        "country_code": (address.get("country_code") or "").upper(),
+    }
+
+
+def forecast_url(lat: float, lon: float, start_date=None, end_date=None) -> str:
+    params = {
+        "latitude": lat,
+        "longitude": lon,
+        "daily": ",".join(FORECAST_DAILY_FIELDS),
+        "timezone": "auto",
+    }
+    if start_date:
+        params["start_date"] = start_date
+        params["end_date"] = end_date
+    else:
+        params["forecast_days"] = FORECAST_DAYS
+    query = urlencode(params, encoding="utf-8", errors="strict")
+    return f"{OPEN_METEO_BASE_URL}/v1/forecast?{query}"
+
+
+def parse_forecast_response(data: dict):
+    daily = data.get("daily")
+    if not daily or not daily.get("time"):
+        raise ValueError("Некорректный ответ Open-Meteo")
+    return parse_daily_forecast(daily)
+
+
+def multi_forecast_url(points, start_date=None, end_date=None) -> str:
+    return forecast_url(
+        ",".join(str(lat) for lat, _ in points),
+        ",".join(str(lon) for _, lon in points),
+        start_date,
+        end_date,
+    )
+
+
+def parse_multi_forecast_response(data, expected: int):
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or len(data) != expected:
+        raise ValueError("Некорректный ответ Open-Meteo")
+    return [parse_forecast_response(item) for item in data]
+
+
+def lookup_city(city: str, deadline=None):
+    with upstream_stage("geocode"):
+        return parse_geocode_response(
+            UPSTREAM_POOL.get_json(geocode_url(city), GEOCODE_HEADERS, deadline), city
+        )
+
+
+def fetch_forecast_window(lat: float, lon: float, start_date=None, end_date=None, deadline=None):
+    with upstream_stage("forecast"):
+        return parse_forecast_response(
+            UPSTREAM_POOL.get_json(forecast_url(lat, lon, start_date, end_date), deadline=deadline)
+        )
+
+
+def geocode_city(city: str, deadline=None):
+    key = normalize_city(city)
+    found, location = GEOCODE_CACHE.get(key)
+    if not found:
+
+        def resolve():
+            resolved = lookup_city(city, deadline)
+            GEOCODE_CACHE.set(key, resolved)
+            return resolved
+
+        location = UPSTREAM_FLIGHTS.do(("geocode", key), resolve, deadline)
+    if location is None:
+        raise ValueError("Город не найден")
+    return location
+
+
+def stale_weather(lat: str, lon: str, requested_date: str):
+    entry = FORECAST_CACHE.get_stale(forecast_grid_point(lat, lon))
+    if entry is None or entry[1].get(requested_date) is None:
+        return None
+    run, days = entry
+    return {**days[requested_date], "stale_since": run}
+
+
+def fetch_weather(lat: str, lon: str, requested_date: str, deadline=None):
+    try:
+        return fetch_fresh_weather(lat, lon, requested_date, deadline)
+    except Exception:
+        weather = stale_weather(lat, lon, requested_date)
+        if weather is None:
+            raise
+        return weather
+
+
+def fetch_fresh_weather(lat: str, lon: str, requested_date: str, deadline=None):
+    grid_lat, grid_lon = forecast_grid_point(lat, lon)
+    run = forecast_run()
+    key = (grid_lat, grid_lon, run)
+    days = FORECAST_CACHE.get(key)
+    if days is None:
+
+        def fetch_window():
+            window = fetch_forecast_window(grid_lat, grid_lon, deadline=deadline)
+            FORECAST_CACHE.set(key, window, run)
+            return window
+
+        days = UPSTREAM_FLIGHTS.do(("forecast", *key), fetch_window, deadline)
+    if requested_date not in days:
+
+        def fetch_day():
+            merged = {
+                **days,
+                **fetch_forecast_window(
+                    grid_lat,
+                    grid_lon,
+                    start_date=requested_date,
+                    end_date=requested_date,
+                    deadline=deadline,
+                ),
+            }
+            FORECAST_CACHE.set(key, merged, run)
+            return merged
+
+        days = UPSTREAM_FLIGHTS.do(("forecast", *key, requested_date), fetch_day, deadline)
+
+    weather = days.get(requested_date)
+    if weather is None:
+        raise ValueError("Некорректный ответ Open-Meteo")
+    return weather
+
+
+def fetch_forecast_windows(points, start_date=None, end_date=None, deadline=None):
+    with upstream_stage("forecast"):
+        data = UPSTREAM_POOL.get_json(
+            multi_forecast_url(points, start_date, end_date), deadline=deadline
+        )
+        return parse_multi_forecast_response(data, len(points))
+
+
+def missing_forecast_points(forecasts: dict, dates):
+    return [point for point, days in forecasts.items() if any(day not in days for day in dates)]
+
+
+def fetch_weather_batch(points, dates, deadline=None):
+    run = forecast_run()
+    forecasts = {point: FORECAST_CACHE.get((*point, run)) for point in points}
+    missing = [point for point, days in forecasts.items() if days is None]
+    if missing:
+        for point, days in zip(missing, fetch_forecast_windows(missing, deadline=deadline)):
+            FORECAST_CACHE.set((*point, run), days, run)
+            forecasts[point] = days
+
+    partial = missing_forecast_points(forecasts, dates)
+    if partial:
+        windows = fetch_forecast_windows(partial, dates[0], dates[-1], deadline)
+        for point, days in zip(partial, windows):
+            forecasts[point] = {**forecasts[point], **days}
+            FORECAST_CACHE.set((*point, run), forecasts[point], run)
+    return forecasts
+
+
+def top_searched_cities(limit: int, days: int):
+    since = (datetime.now(timezone.utc).date() - timedelta(days=days)).isoformat()
+    rows = query_rows(
+        """
+        SELECT key AS city, SUM(count) AS count
+        FROM rollup_counts
+        WHERE metric = 'search_city' AND day >= ?
+        GROUP BY key
+        ORDER BY count DESC, key
+        LIMIT ?
+        """,
+        (since, limit * 3),
+    )
+    cities = {}
+    for row in rows:
+        cities.setdefault(normalize_city(row["city"]), row["city"])
+    return list(cities.values())[:limit]
+
+
+class ForecastWarmer:
+    def __init__(self, limit: int, lookback_days: int, delay: float, budget: int):
+        self.limit = limit
+        self.lookback_days = lookback_days
+        self.delay = delay
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.last_run = None
+        self.counters = {
+            "runs": 0,
+            "cities": 0,
+            "prefetched": 0,
+            "requests": 0,
+            "overBudget": 0,
+            "failed": 0,
+        }
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def start(self):
+        if self.limit <= 0:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="forecast-warmer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        warmed = None
+        while not self.stopping.is_set():
+            run = forecast_run()
+            if warmed != run and time.time() >= run + self.delay:
+                try:
+                    self.warm(run)
+                except Exception as error:
+                    print(f"Forecast warm-up failed: {error}", file=sys.stderr)
+                warmed = run
+            next_at = run + self.delay
+            if next_at <= time.time():
+                next_at += FORECAST_RUN_INTERVAL
+            self.stopping.wait(max(1.0, next_at - time.time()))
+
+    def warm(self, run: int):
+        points = []
+        cities = top_searched_cities(self.limit, self.lookback_days)
+        forecast_requests = math.ceil(len(cities) / WEATHER_BATCH_MAX_CITIES)
+        budget = self.budget
+        geocode_budget = max(0, budget - forecast_requests)
+        for city in cities:
+            key = normalize_city(city)
+            found, location = GEOCODE_CACHE.get(key)
+            if not found:
+                if geocode_budget <= 0:
+                    self.count("overBudget")
+                    continue
+                geocode_budget -= 1
+                budget -= 1
+                self.count("requests")
+                try:
+                    location = lookup_city(city)
+                except Exception:
+                    self.count("failed")
+                    continue
+                GEOCODE_CACHE.set(key, location)
+            if location is not None:
+                point = forecast_grid_point(location["lat"], location["lon"])
+                if point not in points:
+                    points.append(point)
+
+        missing = [point for point in points if FORECAST_CACHE.get((*point, run)) is None]
+        for start in range(0, len(missing), WEATHER_BATCH_MAX_CITIES):
+            chunk = missing[start : start + WEATHER_BATCH_MAX_CITIES]
+            if budget <= 0:
+                self.count("overBudget", len(chunk))
+                continue
+            budget -= 1
+            self.count("requests")
+            try:
+                windows = fetch_forecast_windows(chunk)
+            except Exception:
+                self.count("failed", len(chunk))
+                continue
+            for point, days in zip(chunk, windows):
+                FORECAST_CACHE.set((*point, run), days, run)
+            self.count("prefetched", len(chunk))
+
+        with self.lock:
+            self.counters["runs"] += 1
+            self.counters["cities"] = len(cities)
+            self.last_run = utc_now_iso()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["running"] = self.thread is not None
+            stats["lastRun"] = self.last_run
+        return stats
+
+
+FORECAST_WARMER = ForecastWarmer(
+    FORECAST_WARM_CITIES, FORECAST_WARM_LOOKBACK_DAYS, FORECAST_WARM_DELAY, FORECAST_WARM_BUDGET
+)
+
+
+class AsyncUpstreamClient:
+    def __init__(self, max_concurrency: int, timeouts=None, default_timeouts=(3.0, 10.0)):
+        self.max_concurrency = max_concurrency
+        self.timeouts = timeouts or {}
+        self.default_timeouts = default_timeouts
+        self.ssl_context = ssl.create_default_context()
+        self.semaphore = None
+        self.idle = {}
+        self.counters = {"created": 0, "reused": 0, "retried": 0, "waiting": 0}
+
+    async def checkout(self, origin):
+        idle = self.idle.setdefault(origin, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self.counters["reused"] += 1
+                return reader, writer, True
+            writer.close()
+
+        scheme, host, port = origin
+        connect_timeout, _ = self.timeouts.get(host, self.default_timeouts)
+        secure = scheme == "https"
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host,
+                port or (443 if secure else 80),
+                ssl=self.ssl_context if secure else None,
+                server_hostname=host if secure else None,
+            ),
+            connect_timeout,
+        )
+        self.counters["created"] += 1
+        return reader, writer, False
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Upstream closed the connection")
+        _, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+        return int(status), reason, headers, body
+
+    async def request(self, url: str, headers=None, deadline=None):
+        if deadline is None:
+            return await self.fetch(url, headers)
+        try:
+            return await asyncio.wait_for(self.fetch(url, headers), deadline.timeout())
+        except asyncio.TimeoutError:
+            if deadline.remaining() <= 0:
+                raise DeadlineExceeded() from None
+            raise
+
+    async def fetch(self, url: str, headers=None):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        parsed = urlparse(url)
+        origin = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+        host_header = parsed.netloc.rsplit("@", 1)[-1]
+        request_headers = {
+            "Host": host_header,
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+            **(headers or {}),
+        }
+        raw_request = (
+            f"GET {path} HTTP/1.1\r\n"
+            + "".join(f"{name}: {value}\r\n" for name, value in request_headers.items())
+            + "\r\n"
+        ).encode("utf-8")
+        _, read_timeout = self.timeouts.get(parsed.hostname, self.default_timeouts)
+
+        self.counters["waiting"] += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.counters["waiting"] -= 1
+        try:
+            for attempt in range(2):
+                reader, writer, reused = await self.checkout(origin)
+                try:
+                    writer.write(raw_request)
+                    await writer.drain()
+                    status, reason, response_headers, body = await asyncio.wait_for(
+                        self.read_response(reader), read_timeout
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt == 0:
+                        self.counters["retried"] += 1
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if response_headers.get("connection", "").lower() == "close":
+                    writer.close()
+                else:
+                    self.idle.setdefault(origin, []).append((reader, writer))
+                break
+        finally:
+            self.semaphore.release()
+
+        if response_headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        if status >= 400:
+            raise UpstreamError(f"HTTP Error {status}: {reason}", status)
+        return body
+
+    async def get_json(self, url: str, headers=None, deadline=None):
+        async def attempt():
+            return json.loads((await self.request(url, headers, deadline)).decode("utf-8"))
+
+        return await upstream_guard(url).call_async(attempt, deadline)
+
+    async def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["idle"] = sum(len(connections) for connections in self.idle.values())
+        return stats
+
+
+ASYNC_UPSTREAM = AsyncUpstreamClient(
+    ASYNC_UPSTREAM_CONCURRENCY,
+    timeouts={
+        urlparse(NOMINATIM_BASE_URL).hostname: (NOMINATIM_CONNECT_TIMEOUT, NOMINATIM_READ_TIMEOUT),
+        urlparse(OPEN_METEO_BASE_URL).hostname: (OPEN_METEO_CONNECT_TIMEOUT, OPEN_METEO_READ_TIMEOUT),
+    },
+)
+
+
+async def geocode_city_async(city: str, deadline=None):
+    key = normalize_city(city)
+    cached = GEOCODE_CACHE.get(key, memory_only=True)
+    found, location = cached or await asyncio.get_running_loop().run_in_executor(
+        None, GEOCODE_CACHE.get, key
+    )
+    if not found:
+
+        async def resolve():
+            with upstream_stage("geocode"):
+                data = await ASYNC_UPSTREAM.get_json(geocode_url(city), GEOCODE_HEADERS, deadline)
+                resolved = parse_geocode_response(data, city)
+            await asyncio.get_running_loop().run_in_executor(None, GEOCODE_CACHE.set, key, resolved)
+            return resolved
+
+        location = await UPSTREAM_FLIGHTS.do_async(("geocode", key), resolve, deadline)
+    if location is None:
+        raise ValueError("Город не найден")
+    return location
+
+
+async def fetch_weather_async(lat: str, lon: str, requested_date: str, deadline=None):
+    try:
+        return await fetch_fresh_weather_async(lat, lon, requested_date, deadline)
+    except Exception:
+        weather = await asyncio.get_running_loop().run_in_executor(
+            None, stale_weather, lat, lon, requested_date
+        )
+        if weather is None:
+            raise
+        return weather
+
+
+async def fetch_fresh_weather_async(lat: str, lon: str, requested_date: str, deadline=None):
+    grid_lat, grid_lon = forecast_grid_point(lat, lon)
+    run = forecast_run()
+    key = (grid_lat, grid_lon, run)
+    days = await FORECAST_CACHE.get_async(key)
+    if days is None:
+
+        async def fetch_window():
+            with upstream_stage("forecast"):
+                data = await ASYNC_UPSTREAM.get_json(
+                    forecast_url(grid_lat, grid_lon), deadline=deadline
+                )
+                window = parse_forecast_response(data)
+            await FORECAST_CACHE.set_async(key, window, run)
+            return window
+
+        days = await UPSTREAM_FLIGHTS.do_async(("forecast", *key), fetch_window, deadline)
+    if requested_date not in days:
+
+        async def fetch_day():
+            with upstream_stage("forecast"):
+                data = await ASYNC_UPSTREAM.get_json(
+                    forecast_url(grid_lat, grid_lon, requested_date, requested_date),
+                    deadline=deadline,
+                )
+                merged = {**days, **parse_forecast_response(data)}
+            await FORECAST_CACHE.set_async(key, merged, run)
+            return merged
+
+        days = await UPSTREAM_FLIGHTS.do_async(
+            ("forecast", *key, requested_date), fetch_day, deadline
+        )
+
+    weather = days.get(requested_date)
+    if weather is None:
+        raise ValueError("Некорректный ответ Open-Meteo")
+    return weather
+
+
+async def fetch_forecast_windows_async(points, start_date=None, end_date=None, deadline=None):
+    with upstream_stage("forecast"):
+        data = await ASYNC_UPSTREAM.get_json(
+            multi_forecast_url(points, start_date, end_date), deadline=deadline
+        )
+        return parse_multi_forecast_response(data, len(points))
+
+
+async def fetch_weather_batch_async(points, dates, deadline=None):
+    run = forecast_run()
+    forecasts = {point: await FORECAST_CACHE.get_async((*point, run)) for point in points}
+    missing = [point for point, days in forecasts.items() if days is None]
+    if missing:
+        windows = await fetch_forecast_windows_async(missing, deadline=deadline)
+        for point, days in zip(missing, windows):
+            await FORECAST_CACHE.set_async((*point, run), days, run)
+            forecasts[point] = days
+
+    partial = missing_forecast_points(forecasts, dates)
+    if partial:
+        windows = await fetch_forecast_windows_async(partial, dates[0], dates[-1], deadline)
+        for point, days in zip(partial, windows):
+            forecasts[point] = {**forecasts[point], **days}
+            await FORECAST_CACHE.set_async((*point, run), forecasts[point], run)
+    return forecasts
+
+
+def rollup_top(metric: str, key_name: str, limit=None):
+    sql = f"""
+        SELECT key AS {key_name}, SUM(count) AS count
+        FROM rollup_counts
+        WHERE metric = ?
+        GROUP BY key
+        ORDER BY count DESC, key DESC
+    """
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return query_rows(sql, (metric,))
+
+
+def rollup_event_total(event_type: str):
+    row = query_one(
+        """
+        SELECT COALESCE(SUM(count), 0) AS total
+        FROM rollup_counts
+        WHERE metric = 'event' AND key = ?
+        """,
+        (event_type,),
+    )
+    return (row or {}).get("total", 0) or 0
+
+
+def query_recent_errors(limit: int):
+    with READ_POOL.connection() as conn:
+        rows = []
+        for name in reversed(list_partitions(conn)):
+            rows.extend(
+                conn.execute(
+                    f"""
+                    SELECT substr(ts, 1, 19) AS ts, COALESCE(error_message, '') AS message
+                    FROM {name}
+                    WHERE event_type_id = (SELECT id FROM event_strings WHERE value = 'error')
+                    ORDER BY ts_epoch DESC, id DESC
+                    LIMIT ?
+                    """,
+                    (limit - len(rows),),
+                ).fetchall()
+            )
+            if len(rows) >= limit:
+                break
+        return [event_row_to_dict(row) for row in rows]
+
+
+def perf_quantiles(start_day=None, end_day=None, quantiles=(0.5, 0.9, 0.95, 0.99)):
+    rows = query_rows(
+        """
+        SELECT sketch
+        FROM perf_sketches
+        WHERE day >= COALESCE(?, '') AND day <= COALESCE(?, '9999-12-31')
+        """,
+        (start_day, end_day),
+    )
+    merged = QuantileSketch()
+    for row in rows:
+        merged.merge(QuantileSketch.from_bytes(row["sketch"]))
+    return {q: merged.quantile(q) for q in quantiles}
+
+
+def exact_retention():
+    users_row = query_one(
+        """
+        SELECT
+            COUNT(DISTINCT client_id) AS total_users,
+            COUNT(DISTINCT CASE WHEN day = date('now') THEN client_id END) AS dau,
+            COUNT(DISTINCT CASE WHEN day >= date('now', '-6 day') THEN client_id END) AS wau,
+            COUNT(DISTINCT CASE WHEN day >= date('now', '-29 day') THEN client_id END) AS mau
+        FROM rollup_client_days
+        """
+    )
+    returning_row = query_one(
+        """
+        SELECT COUNT(*) AS returning_users
+        FROM (
+            SELECT client_id
+            FROM rollup_client_days
+            GROUP BY client_id
+            HAVING COUNT(*) > 1
+        )
+        """
+    )
+    d1_row = query_one(
+        """
+        SELECT
+            COUNT(*) AS base_days,
+            COALESCE(SUM(EXISTS (
+                SELECT 1
+                FROM rollup_client_days next_day
+                WHERE next_day.client_id = ud.client_id
+                  AND next_day.day = date(ud.day, '+1 day')
+            )), 0) AS retained_days
+        FROM rollup_client_days ud
+        WHERE ud.day < date('now')
+        """
+    )
+    users_row = users_row or {}
+    return {
+        "total_users": users_row.get("total_users", 0) or 0,
+        "returning_users": (returning_row or {}).get("returning_users", 0) or 0,
+        "base_days": (d1_row or {}).get("base_days", 0) or 0,
+        "retained_days": (d1_row or {}).get("retained_days", 0) or 0,
+        "dau": users_row.get("dau", 0) or 0,
+        "wau": users_row.get("wau", 0) or 0,
+        "mau": users_row.get("mau", 0) or 0,
+    }
+
+
+def approx_retention():
+    rows = query_rows("SELECT day, registers FROM client_day_hll ORDER BY day")
+    days = [row["day"] for row in rows]
+    sketches = [HyperLogLog.from_bytes(row["registers"]) for row in rows]
+    if not sketches:
+        return {
+            "total_users": 0,
+            "returning_users": 0,
+            "base_days": 0,
+            "retained_days": 0,
+            "dau": 0,
+            "wau": 0,
+            "mau": 0,
+        }
+
+    empty = HyperLogLog()
+    prefix = [empty]
+    for sketch in sketches[:-1]:
+        prefix.append(prefix[-1].union(sketch))
+    suffix = [empty]
+    for sketch in reversed(sketches[1:]):
+        suffix.append(suffix[-1].union(sketch))
+    suffix.reverse()
+
+    everyone = prefix[-1].union(sketches[-1])
+    total_users = everyone.estimate()
+    single_day_users = sum(
+        max(total_users - prefix[i].union(suffix[i]).estimate(), 0) for i in range(len(sketches))
+    )
+
+    today = datetime.now(timezone.utc).date()
+    daily = dict(zip(days, sketches))
+    estimates = {day: sketch.estimate() for day, sketch in daily.items()}
+    base_days = 0.0
+    retained_days = 0.0
+    for day, sketch in daily.items():
+        if day >= today.isoformat():
+            continue
+        base_days += estimates[day]
+        next_day = (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+        if next_day in daily:
+            union = sketch.union(daily[next_day]).estimate()
+            retained_days += max(estimates[day] + estimates[next_day] - union, 0)
+
+    def window(size: int):
+        start = (today - timedelta(days=size - 1)).isoformat()
+        merged = empty
+        for day, sketch in daily.items():
+            if day >= start:
+                merged = merged.union(sketch)
+        return round(merged.estimate())
+
+    return {
+        "total_users": round(total_users),
+        "returning_users": round(min(max(total_users - single_day_users, 0), total_users)),
+        "base_days": base_days,
+        "retained_days": min(retained_days, base_days),
+        "dau": round(estimates.get(today.isoformat(), 0)),
+        "wau": window(7),
+        "mau": window(30),
+    }
+
+
+def build_analytics_payload():
+    views_by_day = query_rows(
+        """
+        SELECT day, count
+        FROM rollup_counts
+        WHERE metric = 'event' AND key = 'page_view'
+        ORDER BY day DESC
+        LIMIT 30
+        """
+    )
+
+    dates_clicked = rollup_top("search_date", "target_date", 20)
+
+    retention = approx_retention() if ANALYTICS_UNIQUES_MODE == "approx" else exact_retention()
+    total_users = retention["total_users"]
+    returning_users = retention["returning_users"]
+    base_days = retention["base_days"]
+    retained_days = retention["retained_days"]
+
+    link_clicks_total = rollup_event_total("link_click")
+    top_links = rollup_top("link", "link_url", 20)
+
+    errors_total = rollup_event_total("error")
+    errors_by_code = rollup_top("error_code", "code")
+    recent_errors = query_recent_errors(10)
+
+    perf_row = query_one(
+        """
+        SELECT
+            COALESCE(SUM(samples), 0) AS samples,
+            ROUND(SUM(total_ms) / SUM(samples), 2) AS avg_ms,
+            ROUND(MAX(max_ms), 2) AS max_ms
+        FROM rollup_perf
+        """
+    )
+    load_quantiles = perf_quantiles()
+
+    entered_cities = rollup_top("search_city", "city", 20)
+    resolved_countries = rollup_top("search_country", "country", 20)
+
+    return {
+        "viewsByDay": views_by_day,
+        "datesClicked": dates_clicked,
+        "retention": {
+            "totalUsers": total_users,
+            "returningUsers": returning_users,
+            "returningRate": round((returning_users / total_users) * 100, 2)
+            if total_users
+            else 0,
+            "d1RetentionRate": round((retained_days / base_days) * 100, 2)
+            if base_days
+            else 0,
+            "dau": retention["dau"],
+            "wau": retention["wau"],
+            "mau": retention["mau"],
+            "mode": ANALYTICS_UNIQUES_MODE,
+        },
+        "linkClicks": {
+            "total": link_clicks_total,
+            "topLinks": top_links,
+        },
+        "errors": {
+            "total": errors_total,
+            "byCode": errors_by_code,
+            "recent": recent_errors,
+        },
+        "pageLoad": {
+            "samples": (perf_row or {}).get("samples", 0) or 0,
+            "avgMs": (perf_row or {}).get("avg_ms", 0) or 0,
+            "p50Ms": round(load_quantiles[0.5] or 0, 2),
+            "p90Ms": round(load_quantiles[0.9] or 0, 2),
+            "p95Ms": round(load_quantiles[0.95] or 0, 2),
+            "p99Ms": round(load_quantiles[0.99] or 0, 2),
+            "maxMs": (perf_row or {}).get("max_ms", 0) or 0,
+        },
+        "searchGeo": {
+            "enteredCities": entered_cities,
+            "countries": resolved_countries,
+        },
+        "caches": {
+            "geocode": GEOCODE_CACHE.stats(),
+            "forecast": FORECAST_CACHE.stats(),
+            "coalescing": UPSTREAM_FLIGHTS.stats(),
+            "static": STATIC_CACHE.stats(),
+            "warmer": FORECAST_WARMER.stats(),
+            "cityIndex": CITY_INDEX.stats(),
+        },
+        "upstreams": {
+            "connections": UPSTREAM_POOL.stats(),
+            "asyncConnections": ASYNC_UPSTREAM.stats(),
+            "breakers": breaker_stats(),
+        },
+        "ingest": {
+            "writer": ANALYTICS_WRITER.stats(),
+            "guard": INGEST_GUARD.stats(),
+        },
+        "generatedAt": utc_now_iso(),
+    }
+
+
+class AnalyticsSnapshot:
+    def __init__(self, builder, ttl: float, max_stale: float):
+        self.builder = builder
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+        self.current = None
+        self.refreshing = False
+        self.counters = {"fresh": 0, "stale": 0, "builds": 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get(self):
+        snapshot = self.current
+        age = time.monotonic() - snapshot["built_at"] if snapshot else None
+        if snapshot is None or age > self.ttl + self.max_stale:
+            return self.rebuild()
+        if age > self.ttl:
+            self.count("stale")
+            self.refresh_in_background()
+        else:
+            self.count("fresh")
+        return snapshot
+
+    def rebuild(self):
+        with self.rebuild_lock:
+            snapshot = self.current
+            if snapshot is not None and time.monotonic() - snapshot["built_at"] <= self.ttl:
+                return snapshot
+            with METRICS.timer("weather_stage_duration_seconds", stage="analytics_build"):
+                body = encode_json(self.builder())
+            digest = hashlib.sha256(body).hexdigest()[:32]
+            snapshot = {
+                "body": body,
+                "etag": f'"{digest}"',
+                "gzip": gzip.compress(body, JSON_GZIP_LEVEL, mtime=0),
+                "gzip_etag": f'"{digest}-gzip"',
+                "built_at": time.monotonic(),
+            }
+            self.current = snapshot
+            self.count("builds")
+            return snapshot
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.rebuild()
+            except Exception as error:
+                print(f"Analytics snapshot rebuild failed: {error}", file=sys.stderr)
+            finally:
+                with self.lock:
+                    self.refreshing = False
+
+        threading.Thread(target=run, name="analytics-snapshot", daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+ANALYTICS_SNAPSHOT = AnalyticsSnapshot(
+    build_analytics_payload, ANALYTICS_CACHE_TTL, ANALYTICS_CACHE_MAX_STALE
+)
+
+
+def etag_matches(header_value: str, etag: str) -> bool:
+    for candidate in (header_value or "").split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", etag):
+            return True
+    return False
+
+
+ASSET_REFERENCE = re.compile(r'(\b(?:href|src)=")([^"?#:]+)(")')
+
+
+def accepted_encodings(header_value: str):
+    accepted = set()
+    for item in (header_value or "").split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        params = params.strip().lower()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name == "*":
+            accepted.update(("br", "gzip"))
+        elif name:
+            accepted.add(name)
+    return accepted
+
+
+class StaticAssetCache:
+    def __init__(self, directory: str, files):
+        self.directory = directory
+        self.files = files
+        self.assets = None
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "notModified": 0, "misses": 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def load(self):
+        assets = {}
+        pages = []
+        for name in self.files:
+            with open(os.path.join(self.directory, name), "rb") as source:
+                body = source.read()
+            if name.endswith(".html"):
+                pages.append((name, body))
+            else:
+                assets[name] = self.build_asset(name, body)
+        for name, body in pages:
+            assets[name] = self.build_asset(name, self.versioned_references(assets, body))
+        self.assets = assets
+
+    def build_asset(self, name: str, body: bytes):
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type.endswith("javascript"):
+            content_type += "; charset=utf-8"
+        digest = hashlib.sha256(body).hexdigest()
+        variants = {"identity": (body, f'"{digest[:20]}"')}
+        if len(body) >= STATIC_MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(body, 9, mtime=0)
+            if len(compressed) < len(body):
+                variants["gzip"] = (compressed, f'"{digest[:20]}-gzip"')
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    variants["br"] = (compressed, f'"{digest[:20]}-br"')
+        return {"content_type": content_type, "version": digest[:10], "variants": variants}
+
+    def versioned_references(self, assets: dict, body: bytes) -> bytes:
+        def replace(match):
+            asset = assets.get(match.group(2).lstrip("/"))
+            if asset is None:
+                return match.group(0)
+            return f"{match.group(1)}{match.group(2)}?v={asset['version']}{match.group(3)}"
+
+        return ASSET_REFERENCE.sub(replace, body.decode("utf-8")).encode("utf-8")
+
+    def response(self, path: str, query: str, request_headers):
+        if self.assets is None:
+            with self.lock:
+                if self.assets is None:
+                    self.load()
+
+        asset = self.assets.get(path.lstrip("/"))
+        if asset is None:
+            self.count("misses")
+            return 404, {"Content-Type": "text/plain; charset=utf-8"}, b"File not found"
+
+        accepted = accepted_encodings(request_headers.get("accept-encoding"))
+        encoding = next(
+            (name for name in ("br", "gzip") if name in accepted and name in asset["variants"]),
+            "identity",
+        )
+        body, etag = asset["variants"][encoding]
+        versioned = parse_qs(query).get("v", [""])[0] == asset["version"]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": STATIC_IMMUTABLE_CACHE_CONTROL if versioned else "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request_headers.get("if-none-match"), etag):
+            self.count("notModified")
+            return 304, headers, b""
+
+        self.count("hits")
+        headers["Content-Type"] = asset["content_type"]
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return 200, headers, body
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        assets = self.assets or {}
+        stats["assets"] = len(assets)
+        stats["bytes"] = sum(
+            len(body) for asset in assets.values() for body, _ in asset["variants"].values()
+        )
+        return stats
+
+
+STATIC_CACHE = StaticAssetCache(BASE_DIR, STATIC_FILES)
+
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_HELP = {
+    "weather_request_duration_seconds": ("histogram", "HTTP request latency by route."),
+    "weather_responses_total": ("counter", "HTTP responses by route and status."),
+    "weather_stage_duration_seconds": ("histogram", "Latency of upstream and storage stages."),
+    "weather_upstream_errors_total": ("counter", "Failed upstream calls by stage and error."),
+    "weather_cache_hit_ratio": ("gauge", "Cache hit ratio since start."),
+    "weather_analytics_queue_depth": ("gauge", "Analytics events waiting in the queue."),
+    "weather_analytics_events_total": ("counter", "Analytics events by writer outcome."),
+    "weather_upstream_connections_total": ("counter", "Upstream connection pool events."),
+    "weather_coalesced_requests_total": ("counter", "Upstream calls by coalescing role."),
+    "weather_upstream_breaker_state": ("gauge", "Circuit breaker state per upstream (1 for the current state)."),
+    "weather_upstream_breaker_rejected_total": ("counter", "Upstream calls rejected by an open breaker."),
+    "weather_upstream_retries_total": ("counter", "Upstream retries spent from the retry budget."),
+    "weather_active_threads": ("gauge", "Live Python threads."),
+}
+
+
+METRICS_ROUTES = (
+    "/api/weather",
+    "/api/weather/batch",
+    "/api/cities/suggest",
+    "/api/track",
+    "/api/analytics",
+    "/api/analytics-login",
+    "/metrics",
+)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def metric_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+def collect_gauges():
+    geocode = GEOCODE_CACHE.stats()
+    forecast = FORECAST_CACHE.stats()
+    static = STATIC_CACHE.stats()
+    static_lookups = static["hits"] + static["notModified"] + static["misses"]
+    writer = ANALYTICS_WRITER.stats()
+    connections = UPSTREAM_POOL.stats()
+    async_connections = ASYNC_UPSTREAM.stats()
+    flights = UPSTREAM_FLIGHTS.stats()
+    samples = [
+        ("weather_cache_hit_ratio", (("cache", "geocode"),), geocode["hitRate"] / 100),
+        ("weather_cache_hit_ratio", (("cache", "forecast"),), forecast["hitRate"] / 100),
+        (
+            "weather_cache_hit_ratio",
+            (("cache", "static"),),
+            (static["hits"] + static["notModified"]) / static_lookups if static_lookups else 0,
+        ),
+        ("weather_analytics_queue_depth", (), writer["queued"]),
+        ("weather_active_threads", (), threading.active_count()),
+    ]
+    for outcome in ("written", "dropped", "failed"):
+        samples.append(("weather_analytics_events_total", (("outcome", outcome),), writer[outcome]))
+    for event in ("created", "reused", "retried"):
+        value = connections[event] + async_connections[event]
+        samples.append(("weather_upstream_connections_total", (("event", event),), value))
+    for role in ("leaders", "deduplicated"):
+        samples.append(("weather_coalesced_requests_total", (("role", role),), flights[role]))
+    for upstream, breaker in breaker_stats().items():
+        for state in ("closed", "open", "half_open"):
+            value = 1 if breaker["state"] == state else 0
+            samples.append(
+                ("weather_upstream_breaker_state", (("upstream", upstream), ("state", state)), value)
+            )
+        labels = (("upstream", upstream),)
+        samples.append(("weather_upstream_breaker_rejected_total", labels, breaker["rejected"]))
+        samples.append(("weather_upstream_retries_total", labels, breaker["retryBudget"]["retries"]))
+    return samples
+
+
+def format_metric_value(value) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def render_metrics() -> str:
+    families = {}
+    for (name, labels), histogram in list(METRICS.histograms.items()):
+        cumulative, total = histogram.snapshot()
+        lines = families.setdefault(name, [])
+        for bound, count in zip((*histogram.buckets, "+Inf"), cumulative):
+            lines.append(f"{name}_bucket{metric_labels((*labels, ('le', bound)))} {count}")
+        lines.append(f"{name}_sum{metric_labels(labels)} {total}")
+        lines.append(f"{name}_count{metric_labels(labels)} {cumulative[-1]}")
+    for (name, labels), counter in list(METRICS.counters.items()):
+        families.setdefault(name, []).append(f"{name}{metric_labels(labels)} {format_metric_value(counter.value())}")
+    for name, labels, value in collect_gauges():
+        families.setdefault(name, []).append(f"{name}{metric_labels(labels)} {format_metric_value(value)}")
+
+    output = []
+    for name, lines in families.items():
+        kind, description = METRICS_HELP.get(name, ("untyped", name))
+        output.append(f"# HELP {name} {description}")
+        output.append(f"# TYPE {name} {kind}")
+        output.extend(lines)
+    return "\n".join(output) + "\n"
+
+
+def metrics_response():
+    return 200, {"Content-Type": METRICS_CONTENT_TYPE}, render_metrics().encode("utf-8")
+
+
+def route_label(path: str) -> str:
+    return path if path in METRICS_ROUTES else "static"
+
+
+def observe_request(path: str, status: int, started: float):
+    route = route_label(path)
+    METRICS.observe("weather_request_duration_seconds", time.perf_counter() - started, route=route)
+    METRICS.inc("weather_responses_total", route=route, status=str(status))
+
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+ANALYTICS_COOKIE = (
+    f"{ANALYTICS_COOKIE_NAME}={ANALYTICS_COOKIE_VALUE}; Path=/; Max-Age=86400; SameSite=Lax"
+)
+
+
+def json_response(status: int, payload: dict, headers=None):
+    return status, {"Content-Type": JSON_CONTENT_TYPE, **(headers or {})}, encode_json(payload)
+
+
+def compress_response(status: int, headers: dict, body: bytes, accept_encoding: str):
+    if (
+        len(body) < JSON_GZIP_MIN_SIZE
+        or "Content-Encoding" in headers
+        or not headers.get("Content-Type", "").startswith("application/json")
+        or "gzip" not in accepted_encodings(accept_encoding)
+    ):
+        return status, headers, body
+    compressed = gzip.compress(body, JSON_GZIP_LEVEL, mtime=0)
+    return status, {**headers, "Content-Encoding": "gzip", "Vary": "Accept-Encoding"}, compressed
+
+
+def parse_cookies(raw: str):
+    cookies = {}
+    for chunk in (raw or "").split(";"):
+        if "=" not in chunk:
+            continue
+        key, value = chunk.split("=", 1)
+        cookies[key.strip()] = value.strip()
+    return cookies
+
+
+def is_analytics_authorized(cookie_header: str) -> bool:
+    return parse_cookies(cookie_header).get(ANALYTICS_COOKIE_NAME) == ANALYTICS_COOKIE_VALUE
+
+
+def has_analytics_password(query: dict) -> bool:
+    return (query.get("password", [""])[0] or "").strip() == ANALYTICS_PASSWORD
+
+
+def static_path_for(path: str, authorized: bool):
+    if path == "/analytics-login":
+        return "/analytics-login.html"
+    if path == "/analytics":
+        return "/analytics.html" if authorized else "/analytics-login.html"
+    if path == "/":
+        return "/index.html"
+    return None
+
+
+def analytics_login_response(raw_body: bytes):
+    try:
+        data = json.loads(raw_body.decode("utf-8"))
+        password = (data.get("password") or "").strip()
+
+        if password != ANALYTICS_PASSWORD:
+            return json_response(401, {"error": "Неверный пароль"})
+        return json_response(200, {"ok": True}, {"Set-Cookie": ANALYTICS_COOKIE})
+    except Exception as error:
+        return json_response(500, {"error": str(error)})
+
+
+def analytics_response(request_headers):
+    try:
+        snapshot = ANALYTICS_SNAPSHOT.get()
+        if "gzip" in accepted_encodings(request_headers.get("accept-encoding")):
+            body, etag = snapshot["gzip"], snapshot["gzip_etag"]
+            encoding = {"Content-Encoding": "gzip"}
+        else:
+            body, etag = snapshot["body"], snapshot["etag"]
+            encoding = {}
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+        if etag_matches(request_headers.get("if-none-match"), etag):
+            return 304, headers, b""
+        return 200, {"Content-Type": JSON_CONTENT_TYPE, **encoding, **headers}, body
+    except Exception as error:
+        return json_response(500, {"error": str(error)})
+
+
+def rate_limited_response():
+    return json_response(
+        429,
+        {"error": "rate limit exceeded"},
+        {"Retry-After": str(INGEST_GUARD.retry_after())},
+    )
+
+
+def track_response(raw_body: bytes):
+    try:
+        try:
+            events, is_batch = parse_track_body(raw_body)
+        except ValueError:
+            return json_response(400, {"error": "Invalid JSON body"})
+
+        if not is_batch:
+            if not isinstance(events[0], dict):
+                return json_response(400, {"error": "event must be a JSON object"})
+            error = track_event_error(events[0])
+            if error:
+                return json_response(400, {"error": error})
+            row = track_event_row(events[0])
+            if not INGEST_GUARD.allow(Counter([row["client_id"]]))[row["client_id"]]:
+                return rate_limited_response()
+            if INGEST_GUARD.sample(row):
+                log_events([row])
+            return json_response(200, {"ok": True})
+
+        if len(events) > TRACK_MAX_BATCH_EVENTS:
+            return json_response(
+                400, {"error": f"Too many events, max {TRACK_MAX_BATCH_EVENTS} per request"}
+            )
+
+        candidates = []
+        results = []
+        for data in events:
+            if not isinstance(data, dict):
+                results.append({"ok": False, "error": "event must be a JSON object"})
+                continue
+            error = track_event_error(data)
+            if error:
+                results.append({"ok": False, "error": error})
+                continue
+            row = track_event_row(data)
+            candidates.append((len(results), row))
+            results.append({"ok": True})
+
+        allowed = INGEST_GUARD.allow(Counter(row["client_id"] for _, row in candidates))
+        if candidates and not any(allowed.values()):
+            return rate_limited_response()
+
+        rows = []
+        for index, row in candidates:
+            if not allowed[row["client_id"]]:
+                results[index] = {"ok": False, "error": "rate limit exceeded"}
+                continue
+            allowed[row["client_id"]] -= 1
+            if INGEST_GUARD.sample(row):
+                rows.append(row)
+
+        if rows:
+            log_events(rows)
+        accepted = sum(1 for result in results if result["ok"])
+        return json_response(
+            200,
+            {"ok": accepted == len(events), "accepted": accepted, "results": results},
+        )
+    except Exception as error:
+        return json_response(500, {"error": str(error)})
+
+
+def parse_weather_request(query: str):
+    params = parse_qs(query)
+    request = {
+        "city": (params.get("city", [""])[0] or "").strip(),
+        "date": (params.get("date", [""])[0] or "").strip(),
+        "purpose": (params.get("purpose", [""])[0] or "").strip(),
+        "client_id": (params.get("clientId", [""])[0] or "").strip(),
+        "session_id": (params.get("sessionId", [""])[0] or "").strip(),
+        "location_id": (params.get("locationId", [""])[0] or "").strip(),
+        "coordinates": None,
+    }
+
+    lat = (params.get("lat", [""])[0] or "").strip()
+    lon = (params.get("lon", [""])[0] or "").strip()
+    if lat or lon:
+        try:
+            coordinates = float(lat), float(lon)
+        except ValueError:
+            coordinates = None
+        if coordinates is None or not (-90 <= coordinates[0] <= 90 and -180 <= coordinates[1] <= 180):
+            return request, json_response(400, {"error": "Неверные координаты в параметрах lat и lon"})
+        request["coordinates"] = coordinates
+
+    if not request["city"]:
+        return request, json_response(400, {"error": "Укажите город в параметре city"})
+    if not request["date"]:
+        return request, json_response(400, {"error": "Укажите дату в параметре date"})
+
+    try:
+        selected_date = date.fromisoformat(request["date"])
+    except ValueError:
+        return request, json_response(
+            400, {"error": "Неверный формат даты. Используйте YYYY-MM-DD"}
+        )
+    return request, unsupported_date_response(selected_date)
+
+
+def unsupported_date_response(selected_date: date):
+    today = date.today()
+    max_supported_date = today + timedelta(days=15)
+    if selected_date < today or selected_date > max_supported_date:
+        return json_response(
+            400,
+            {
+                "error": (
+                    f"Можно выбрать дату только с {today.isoformat()} "
+                    f"по {max_supported_date.isoformat()}"
+                )
+            },
+        )
+    return None
+
+
+def known_location(request: dict):
+    if request["coordinates"]:
+        lat, lon = request["coordinates"]
+        return {
+            "lat": lat,
+            "lon": lon,
+            "resolved_city": request["city"],
+            "country": None,
+            "country_code": None,
+        }
+    if request["location_id"]:
+        return GEOCODE_CACHE.get_by_id(request["location_id"]) or CITY_INDEX.get_by_id(
+            request["location_id"]
+        )
+    return None
+
+
+async def known_location_async(request: dict):
+    if request["coordinates"] or not request["location_id"]:
+        return known_location(request)
+    location = GEOCODE_CACHE.get_by_id(request["location_id"], memory_only=True)
+    if location is None and CITY_INDEX.current is not None:
+        location = CITY_INDEX.get_by_id(request["location_id"])
+    if location is None:
+        location = await asyncio.get_running_loop().run_in_executor(None, known_location, request)
+    return location
+
+
+def city_suggest_response(query: str):
+    params = parse_qs(query)
+    text = (params.get("q", [""])[0] or "").strip()[:100]
+    if not text:
+        return json_response(400, {"error": "Укажите начало названия города в параметре q"})
+    suggestions = [
+        {
+            "city": location["resolved_city"],
+            "country": location.get("country"),
+            "countryCode": location.get("country_code") or None,
+            "locationId": location_id,
+        }
+        for location_id, location in CITY_INDEX.suggest(text, CITY_SUGGEST_LIMIT)
+    ]
+    return json_response(200, {"query": text, "suggestions": suggestions})
+
+
+WEATHER_RESPONSE_FIELDS = {
+    "tempMin": "temperature_2m_min",
+    "tempMax": "temperature_2m_max",
+    "feelsLikeMin": "apparent_temperature_min",
+    "feelsLikeMax": "apparent_temperature_max",
+    "weatherCode": "weather_code",
+}
+
+
+def weather_success(request: dict, location: dict, weather: dict):
+    row = build_event_row(
+        "weather_search",
+        client_id=request["client_id"],
+        session_id=request["session_id"],
+        path="/api/weather",
+        city_input=request["city"],
+        city_resolved=location.get("resolved_city"),
+        country=location.get("country"),
+        country_code=location.get("country_code"),
+        target_date=request["date"],
+        purpose=request["purpose"],
+    )
+    city = location.get("resolved_city") or request["city"]
+    location_id = location_id_for(location["lat"], location["lon"])
+    payload = {
+        "city": city,
+        "date": request["date"],
+        **{name: weather.get(field) for name, field in WEATHER_RESPONSE_FIELDS.items()},
+        "country": location.get("country"),
+        "locationId": location_id,
+    }
+    if "stale_since" in weather:
+        payload.update(stale_marker(weather["stale_since"]))
+        return json_response(200, payload), [row]
+
+    run = forecast_run()
+    key = (location_id, city, location.get("country"), request["date"], run)
+    entry = WEATHER_BODY_CACHE.get(key)
+    if entry is not None:
+        return (200, {"Content-Type": JSON_CONTENT_TYPE}, entry[1]), [row]
+
+    status, headers, body = json_response(200, payload)
+    WEATHER_BODY_CACHE.set(key, body, run + FORECAST_RUN_INTERVAL - time.time())
+    return (status, headers, body), [row]
+
+
+def stale_marker(run: int):
+    return {
+        "stale": True,
+        "staleSince": datetime.fromtimestamp(run, timezone.utc).isoformat(),
+    }
+
+
+def weather_error_status(error: Exception):
+    if isinstance(error, DeadlineExceeded):
+        return 504, "weather_deadline_exceeded"
+    if isinstance(error, CircuitOpen):
+        return 503, "weather_upstream_unavailable"
+    return 500, "weather_fetch_failed"
+
+
+def weather_failure(request: dict, error: Exception):
+    status, error_code = weather_error_status(error)
+    row = build_event_row(
+        "error",
+        client_id=request["client_id"],
+        session_id=request["session_id"],
+        path="/api/weather",
+        city_input=request["city"],
+        target_date=request["date"],
+        purpose=request["purpose"],
+        error_code=error_code,
+        error_message=str(error),
+    )
+    return json_response(status, {"error": str(error)}), [row]
+
+
+def weather_response(query: str):
+    request, error_response = parse_weather_request(query)
+    if error_response:
+        return error_response, []
+    deadline = Deadline(WEATHER_REQUEST_BUDGET)
+    try:
+        location = known_location(request) or geocode_city(
+            request["city"], deadline.stage(WEATHER_GEOCODE_BUDGET_SHARE)
         )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_analytics_event_type ON analytics_events(event_type)"
+        weather = fetch_weather(location["lat"], location["lon"], request["date"], deadline)
+    except Exception as error:
+        return weather_failure(request, error)
+    return weather_success(request, location, weather)
+
+
+async def weather_response_async(query: str):
+    request, error_response = parse_weather_request(query)
+    if error_response:
+        return error_response, []
+    deadline = Deadline(WEATHER_REQUEST_BUDGET)
+    try:
+        location = await known_location_async(request) or await geocode_city_async(
+            request["city"], deadline.stage(WEATHER_GEOCODE_BUDGET_SHARE)
         )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_analytics_client_day ON analytics_events(client_id, ts)"
+        weather = await fetch_weather_async(
+            location["lat"], location["lon"], request["date"], deadline
         )
-        conn.commit()
-    finally:
-        conn.close()
+    except Exception as error:
+        return weather_failure(request, error)
+    return weather_success(request, location, weather)
 
 
-def event_row_to_dict(row):
-    return {k: row[k] for k in row.keys()}
+def parse_batch_request(query: str):
+    params = parse_qs(query)
+    cities = [
+        city.strip()
+        for value in params.get("city", []) + params.get("cities", [])
+        for city in value.split(",")
+        if city.strip()
+    ]
+    request = {
+        "cities": cities,
+        "from": (params.get("from", [""])[0] or "").strip(),
+        "to": (params.get("to", [""])[0] or "").strip(),
+        "purpose": (params.get("purpose", [""])[0] or "").strip(),
+        "client_id": (params.get("clientId", [""])[0] or "").strip(),
+        "session_id": (params.get("sessionId", [""])[0] or "").strip(),
+        "dates": [],
+    }
 
+    if not cities:
+        return request, json_response(400, {"error": "Укажите города в параметре cities"})
+    if len({normalize_city(city) for city in cities}) > WEATHER_BATCH_MAX_CITIES:
+        return request, json_response(
+            400, {"error": f"Можно запросить не больше {WEATHER_BATCH_MAX_CITIES} городов"}
+        )
+    if not request["from"]:
+        return request, json_response(400, {"error": "Укажите дату в параметре from"})
 
-def log_event(event_type: str, **kwargs):
-    conn = db_connect()
     try:
-        payload = {
-            "ts": utc_now_iso(),
-            "event_type": event_type,
-            "client_id": kwargs.get("client_id"),
-            "session_id": kwargs.get("session_id"),
-            "path": kwargs.get("path"),
-            "city_input": kwargs.get("city_input"),
-            "city_resolved": kwargs.get("city_resolved"),
-            "country": kwargs.get("country"),
-            "country_code": kwargs.get("country_code"),
-            "target_date": kwargs.get("target_date"),
-            "purpose": kwargs.get("purpose"),
-            "link_url": kwargs.get("link_url"),
-            "error_code": kwargs.get("error_code"),
-            "error_message": kwargs.get("error_message"),
-            "load_ms": kwargs.get("load_ms"),
-            "meta_json": json.dumps(kwargs.get("meta") or {}, ensure_ascii=False),
-        }
-        conn.execute(
-            """
-            INSERT INTO analytics_events (
-                ts, event_type, client_id, session_id, path,
-                city_input, city_resolved, country, country_code,
-                target_date, purpose, link_url, error_code,
-                error_message, load_ms, meta_json
-            ) VALUES (
-                :ts, :event_type, :client_id, :session_id, :path,
-                :city_input, :city_resolved, :country, :country_code,
-                :target_date, :purpose, :link_url, :error_code,
-                :error_message, :load_ms, :meta_json
-            )
-            """,
-            payload,
+        start = date.fromisoformat(request["from"])
+        end = date.fromisoformat(request["to"] or request["from"])
+    except ValueError:
+        return request, json_response(
+            400, {"error": "Неверный формат даты. Используйте YYYY-MM-DD"}
         )
-        conn.commit()
-    finally:
-        conn.close()
+    if end < start:
+        return request, json_response(400, {"error": "Дата to раньше даты from"})
+    error_response = unsupported_date_response(start) or unsupported_date_response(end)
+    if error_response:
+        return request, error_response
 
+    request["dates"] = [
+        (start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)
+    ]
+    return request, None
 
-def query_rows(sql: str, params=()):
-    conn = db_connect()
-    try:
-        rows = conn.execute(sql, params).fetchall()
-        return [event_row_to_dict(r) for r in rows]
-    finally:
-        conn.close()
 
+def unique_cities(cities):
+    unique = {}
+    for city in cities:
+        unique.setdefault(normalize_city(city), city)
+    return unique
 
-def query_one(sql: str, params=()):
-    conn = db_connect()
-    try:
-        row = conn.execute(sql, params).fetchone()
-        return event_row_to_dict(row) if row else None
-    finally:
-        conn.close()
 
+def geocode_batch(cities, deadline=None):
+    locations = {}
+    for key, city in unique_cities(cities).items():
+        try:
+            locations[key] = geocode_city(city, deadline)
+        except Exception as error:
+            locations[key] = error
+    return locations
 
-def build_analytics_payload():
-    views_by_day = query_rows(
-        """
-        SELECT substr(ts, 1, 10) AS day, COUNT(*) AS count
-        FROM analytics_events
-        WHERE event_type = 'page_view'
-        GROUP BY day
-        ORDER BY day DESC
-        LIMIT 30
-        """
-    )
 
-    dates_clicked = query_rows(
-        """
-        SELECT target_date, COUNT(*) AS count
-        FROM analytics_events
-        WHERE event_type = 'weather_search' AND target_date IS NOT NULL
-        GROUP BY target_date
-        ORDER BY count DESC, target_date DESC
-        LIMIT 20
-        """
+async def geocode_batch_async(cities, deadline=None):
+    unique = unique_cities(cities)
+    results = await asyncio.gather(
+        *(geocode_city_async(city, deadline) for city in unique.values()), return_exceptions=True
     )
+    return dict(zip(unique, results))
 
-    total_users_row = query_one(
-        """
-        SELECT COUNT(DISTINCT client_id) AS total_users
-        FROM analytics_events
-        WHERE client_id IS NOT NULL AND client_id != ''
-        """
-    )
-    returning_row = query_one(
-        """
-        SELECT COUNT(*) AS returning_users
-        FROM (
-            SELECT client_id
-            FROM analytics_events
-            WHERE client_id IS NOT NULL AND client_id != ''
-            GROUP BY client_id
-            HAVING COUNT(DISTINCT substr(ts, 1, 10)) > 1
-        )
-        """
-    )
 
-    d1_row = query_one(
-        """
-        WITH user_days AS (
-            SELECT DISTINCT client_id, substr(ts, 1, 10) AS day
-            FROM analytics_events
-            WHERE client_id IS NOT NULL AND client_id != ''
-        ),
-        pairs AS (
-            SELECT ud.client_id, ud.day,
-                   CASE WHEN EXISTS (
-                       SELECT 1
-                       FROM user_days ud2
-                       WHERE ud2.client_id = ud.client_id
-                         AND ud2.day = date(ud.day, '+1 day')
-                   ) THEN 1 ELSE 0 END AS retained
-            FROM user_days ud
-            WHERE ud.day < date('now')
-        )
-        SELECT
-            COUNT(*) AS base_days,
-            COALESCE(SUM(retained), 0) AS retained_days
-        FROM pairs
-        """
+def batch_points(locations: dict):
+    return sorted(
+        {
+            forecast_grid_point(location["lat"], location["lon"])
+            for location in locations.values()
+            if not isinstance(location, BaseException)
+        }
     )
 
-    total_users = (total_users_row or {}).get("total_users", 0) or 0
-    returning_users = (returning_row or {}).get("returning_users", 0) or 0
-    base_days = (d1_row or {}).get("base_days", 0) or 0
-    retained_days = (d1_row or {}).get("retained_days", 0) or 0
 
-    link_clicks_total = query_one(
-        "SELECT COUNT(*) AS total FROM analytics_events WHERE event_type = 'link_click'"
-    )
-    top_links = query_rows(
-        """
-        SELECT link_url, COUNT(*) AS count
-        FROM analytics_events
-        WHERE event_type = 'link_click' AND link_url IS NOT NULL
-        GROUP BY link_url
-        ORDER BY count DESC
-        LIMIT 20
-        """
-    )
+def weather_batch_result(request: dict, locations: dict, forecasts: dict, forecast_error=None):
+    results = []
+    rows = []
+    columns = {name: [] for name in WEATHER_RESPONSE_FIELDS}
+    errors = []
+    for city in request["cities"]:
+        location = locations[normalize_city(city)]
+        error = location if isinstance(location, BaseException) else forecast_error
+        stale = None
+        if error is forecast_error and error is not None:
+            stale = FORECAST_CACHE.get_stale(forecast_grid_point(location["lat"], location["lon"]))
+            if stale is not None:
+                error = None
+        event = {
+            "client_id": request["client_id"],
+            "session_id": request["session_id"],
+            "path": "/api/weather/batch",
+            "city_input": city,
+            "target_date": request["dates"][0],
+            "purpose": request["purpose"],
+        }
 
-    errors_total = query_one(
-        "SELECT COUNT(*) AS total FROM analytics_events WHERE event_type = 'error'"
-    )
-    errors_by_code = query_rows(
-        """
-        SELECT COALESCE(error_code, 'unknown') AS code, COUNT(*) AS count
-        FROM analytics_events
-        WHERE event_type = 'error'
-        GROUP BY code
-        ORDER BY count DESC
-        """
-    )
-    recent_errors = query_rows(
-        """
-        SELECT substr(ts, 1, 19) AS ts, COALESCE(error_message, '') AS message
-        FROM analytics_events
-        WHERE event_type = 'error'
-        ORDER BY ts DESC
-        LIMIT 10
-        """
-    )
+        if error is not None:
+            errors.append(error)
+            results.append({"input": city, "error": str(error)})
+            for column in columns.values():
+                column.append(None)
+            rows.append(
+                build_event_row(
+                    "error",
+                    error_code=weather_error_status(error)[1],
+                    error_message=str(error),
+                    **event,
+                )
+            )
+            continue
 
-    perf_row = query_one(
-        """
-        SELECT
-            COUNT(*) AS samples,
-            ROUND(AVG(load_ms), 2) AS avg_ms,
-            ROUND(MAX(load_ms), 2) AS max_ms
-        FROM analytics_events
-        WHERE event_type = 'page_perf' AND load_ms IS NOT NULL
-        """
-    )
-    p95_row = query_one(
-        """
-        SELECT ROUND(load_ms, 2) AS p95_ms
-        FROM analytics_events
-        WHERE event_type = 'page_perf' AND load_ms IS NOT NULL
-        ORDER BY load_ms
-        LIMIT 1 OFFSET (
-            SELECT CAST(COUNT(*) * 0.95 AS INT)
-            FROM analytics_events
-            WHERE event_type = 'page_perf' AND load_ms IS NOT NULL
+        result = {
+            "input": city,
+            "city": location.get("resolved_city") or city,
+            "country": location.get("country"),
+            "locationId": location_id_for(location["lat"], location["lon"]),
+        }
+        if stale is not None:
+            run, days = stale
+            result.update(stale_marker(run))
+        else:
+            days = forecasts[forecast_grid_point(location["lat"], location["lon"])]
+        results.append(result)
+        for name, field in WEATHER_RESPONSE_FIELDS.items():
+            columns[name].append([(days.get(day) or {}).get(field) for day in request["dates"]])
+        rows.append(
+            build_event_row(
+                "weather_search",
+                city_resolved=location.get("resolved_city"),
+                country=location.get("country"),
+                country_code=location.get("country_code"),
+                **event,
+            )
         )
-        """
-    )
 
-    entered_cities = query_rows(
-        """
-        SELECT city_input AS city, COUNT(*) AS count
-        FROM analytics_events
-        WHERE event_type = 'weather_search' AND city_input IS NOT NULL AND city_input != ''
-        GROUP BY city_input
-        ORDER BY count DESC
-        LIMIT 20
-        """
-    )
+    payload = {"dates": request["dates"], "locations": results, "columns": columns}
+    if len(errors) == len(results):
+        statuses = {weather_error_status(error)[0] for error in errors}
+        payload["error"] = str(errors[0])
+        return json_response(statuses.pop() if len(statuses) == 1 else 500, payload), rows
+    return json_response(200, payload), rows
 
-    resolved_countries = query_rows(
-        """
-        SELECT COALESCE(country, 'Unknown') AS country, COUNT(*) AS count
-        FROM analytics_events
-        WHERE event_type = 'weather_search'
-        GROUP BY COALESCE(country, 'Unknown')
-        ORDER BY count DESC
-        LIMIT 20
-        """
-    )
 
-    return {
-        "viewsByDay": views_by_day,
-        "datesClicked": dates_clicked,
-        "retention": {
-            "totalUsers": total_users,
-            "returningUsers": returning_users,
-            "returningRate": round((returning_users / total_users) * 100, 2)
-            if total_users
-            else 0,
-            "d1RetentionRate": round((retained_days / base_days) * 100, 2)
-            if base_days
-            else 0,
-        },
-        "linkClicks": {
-            "total": (link_clicks_total or {}).get("total", 0) or 0,
-            "topLinks": top_links,
-        },
-        "errors": {
-            "total": (errors_total or {}).get("total", 0) or 0,
-            "byCode": errors_by_code,
-            "recent": recent_errors,
-        },
-        "pageLoad": {
-            "samples": (perf_row or {}).get("samples", 0) or 0,
-            "avgMs": (perf_row or {}).get("avg_ms", 0) or 0,
-            "p95Ms": (p95_row or {}).get("p95_ms", 0) or 0,
-            "maxMs": (perf_row or {}).get("max_ms", 0) or 0,
-        },
-        "searchGeo": {
-            "enteredCities": entered_cities,
-            "countries": resolved_countries,
-        },
-    }
+def weather_batch_response(query: str):
+    request, error_response = parse_batch_request(query)
+    if error_response:
+        return error_response, []
+    deadline = Deadline(WEATHER_REQUEST_BUDGET)
+    locations = geocode_batch(request["cities"], deadline.stage(WEATHER_GEOCODE_BUDGET_SHARE))
+    points = batch_points(locations)
+    forecasts = {}
+    forecast_error = None
+    if points:
+        try:
+            forecasts = fetch_weather_batch(points, request["dates"], deadline)
+        except Exception as error:
+            forecast_error = error
+    return weather_batch_result(request, locations, forecasts, forecast_error)
+
+
+async def weather_batch_response_async(query: str):
+    request, error_response = parse_batch_request(query)
+    if error_response:
+        return error_response, []
+    deadline = Deadline(WEATHER_REQUEST_BUDGET)
+    locations = await geocode_batch_async(
+        request["cities"], deadline.stage(WEATHER_GEOCODE_BUDGET_SHARE)
+    )
+    points = batch_points(locations)
+    forecasts = {}
+    forecast_error = None
+    if points:
+        try:
+            forecasts = await fetch_weather_batch_async(points, request["dates"], deadline)
+        except Exception as error:
+            forecast_error = error
+    if forecast_error is not None:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, weather_batch_result, request, locations, forecasts, forecast_error
+        )
+    return weather_batch_result(request, locations, forecasts, forecast_error)
 
 
 class WeatherHandler(SimpleHTTPRequestHandler):
-    def parse_cookies(self):
-        raw = self.headers.get("Cookie", "")
-        cookies = {}
-        for chunk in raw.split(";"):
-            if "=" not in chunk:
-                continue
-            key, value = chunk.split("=", 1)
-            cookies[key.strip()] = value.strip()
-        return cookies
+    def handle_one_request(self):
+        self.command = None
+        self.status_code = 0
+        super().handle_one_request()
+        if self.command:
+            observe_request(urlparse(self.path).path, self.status_code, self.started)
 
-    def is_analytics_authorized(self) -> bool:
-        cookies = self.parse_cookies()
-        return cookies.get(ANALYTICS_COOKIE_NAME) == ANALYTICS_COOKIE_VALUE
+    def parse_request(self):
+        self.started = time.perf_counter()
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
 
     def do_GET(self):
         parsed = urlparse(self.path)
         query = parse_qs(parsed.query)
+        authorized = is_analytics_authorized(self.headers.get("Cookie", ""))
 
-        if parsed.path == "/analytics" and (
-            (query.get("password", [""])[0] or "").strip() == ANALYTICS_PASSWORD
-        ):
-            self.send_response(302)
-            self.send_header("Location", "/analytics")
-            self.send_header(
-                "Set-Cookie",
-                f"{ANALYTICS_COOKIE_NAME}={ANALYTICS_COOKIE_VALUE}; Path=/; Max-Age=86400; SameSite=Lax",
+        if parsed.path == "/analytics" and has_analytics_password(query):
+            self.send_response_tuple(
+                302, {"Location": "/analytics", "Set-Cookie": ANALYTICS_COOKIE}, b""
             )
-            self.end_headers()
             return
 
         if parsed.path == "/api/weather":
-            self.handle_weather(parsed.query)
+            response, rows = weather_response(parsed.query)
+            self.send_response_tuple(*response)
+            self.wfile.flush()
+            log_events(rows)
+            return
+
+        if parsed.path == "/api/weather/batch":
+            response, rows = weather_batch_response(parsed.query)
+            self.send_response_tuple(*response)
+            self.wfile.flush()
+            log_events(rows)
+            return
+
+        if parsed.path == "/api/cities/suggest":
+            self.send_response_tuple(*city_suggest_response(parsed.query))
             return
 
         if parsed.path == "/api/analytics":
-            has_password_query = (
-                (query.get("password", [""])[0] or "").strip() == ANALYTICS_PASSWORD
-            )
-            if not self.is_analytics_authorized() and not has_password_query:
-                self.send_json(401, {"error": "Unauthorized"})
+            if not authorized and not has_analytics_password(query):
+                self.send_response_tuple(*json_response(401, {"error": "Unauthorized"}))
                 return
-            self.handle_analytics()
+            self.send_response_tuple(*analytics_response(self.headers))
             return
 
-        if parsed.path == "/analytics-login":
-            self.path = "/analytics-login.html"
-            return super().do_GET()
-
-        if parsed.path == "/analytics":
-            if not self.is_analytics_authorized():
-                self.path = "/analytics-login.html"
-                return super().do_GET()
-            self.path = "/analytics.html"
-            return super().do_GET()
+        if parsed.path == "/metrics":
+            if not authorized and not has_analytics_password(query):
+                self.send_response_tuple(*json_response(401, {"error": "Unauthorized"}))
+                return
+            self.send_response_tuple(*metrics_response())
+            return
 
-        if parsed.path == "/":
-            self.path = "/index.html"
+        self.send_static(parsed, authorized)
 
-        return super().do_GET()
+    def do_HEAD(self):
+        parsed = urlparse(self.path)
+        self.send_static(parsed, is_analytics_authorized(self.headers.get("Cookie", "")), False)
 
     def do_POST(self):
         parsed = urlparse(self.path)
+        error = request_body_error(self.headers.get("Content-Length"))
+        if error:
+            self.close_connection = True
+            self.send_response_tuple(*error)
+            return
 
         if parsed.path == "/api/analytics-login":
-            self.handle_analytics_login()
+            self.send_response_tuple(*analytics_login_response(self.read_body()))
             return
 
         if parsed.path == "/api/track":
-            self.handle_track_event()
+            self.send_response_tuple(*track_response(self.read_body()))
             return
 
         self.send_response(404)
         self.end_headers()
 
-    def handle_analytics_login(self):
-        try:
-            content_length = int(self.headers.get("Content-Length", "0"))
-            raw_body = self.rfile.read(content_length) if content_length else b"{}"
-            data = json.loads(raw_body.decode("utf-8"))
-            password = (data.get("password") or "").strip()
+    def read_body(self) -> bytes:
+        content_length = int(self.headers.get("Content-Length", "0"))
+        return self.rfile.read(content_length) if content_length else b"{}"
 
-            if password != ANALYTICS_PASSWORD:
-                self.send_json(401, {"error": "Неверный пароль"})
-                return
+    def send_static(self, parsed, authorized: bool, send_body: bool = True):
+        path = static_path_for(parsed.path, authorized) or parsed.path
+        self.send_response_tuple(
+            *STATIC_CACHE.response(path, parsed.query, self.headers), send_body=send_body
+        )
 
-            body = json.dumps({"ok": True}, ensure_ascii=True).encode("utf-8")
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.send_header("Content-Length", str(len(body)))
-            self.send_header(
-                "Set-Cookie",
-                f"{ANALYTICS_COOKIE_NAME}={ANALYTICS_COOKIE_VALUE}; Path=/; Max-Age=86400; SameSite=Lax",
-            )
-            self.end_headers()
+    def send_response_tuple(self, status: int, headers: dict, body: bytes, send_body: bool = True):
+        status, headers, body = compress_response(
+            status, headers, body, self.headers.get("Accept-Encoding")
+        )
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
             self.wfile.write(body)
-        except Exception as error:
-            self.send_json(500, {"error": str(error)})
 
-    def handle_analytics(self):
-        try:
-            payload = build_analytics_payload()
-            self.send_json(200, payload)
-        except Exception as error:
-            self.send_json(500, {"error": str(error)})
 
-    def handle_track_event(self):
-        try:
-            content_length = int(self.headers.get("Content-Length", "0"))
-            raw_body = self.rfile.read(content_length) if content_length else b"{}"
-            data = json.loads(raw_body.decode("utf-8"))
+async def dispatch_async(method: str, target: str, headers: dict, body: bytes, deferred: list):
+    parsed = urlparse(target)
+    query = parse_qs(parsed.query)
+    authorized = is_analytics_authorized(headers.get("cookie", ""))
+    loop = asyncio.get_running_loop()
 
-            event_type = (data.get("eventType") or "").strip()
-            if not event_type:
-                self.send_json(400, {"error": "eventType is required"})
-                return
+    if method in ("GET", "HEAD"):
+        if parsed.path == "/analytics" and has_analytics_password(query):
+            return 302, {"Location": "/analytics", "Set-Cookie": ANALYTICS_COOKIE}, b""
+        if parsed.path == "/api/weather":
+            response, rows = await weather_response_async(parsed.query)
+            deferred.extend(rows)
+            return response
+        if parsed.path == "/api/weather/batch":
+            response, rows = await weather_batch_response_async(parsed.query)
+            deferred.extend(rows)
+            return response
+        if parsed.path == "/api/cities/suggest":
+            return city_suggest_response(parsed.query)
+        if parsed.path == "/api/analytics":
+            if not authorized and not has_analytics_password(query):
+                return json_response(401, {"error": "Unauthorized"})
+            return await loop.run_in_executor(None, analytics_response, headers)
+        if parsed.path == "/metrics":
+            if not authorized and not has_analytics_password(query):
+                return json_response(401, {"error": "Unauthorized"})
+            return metrics_response()
+        path = static_path_for(parsed.path, authorized) or parsed.path
+        return STATIC_CACHE.response(path, parsed.query, headers)
 
-            log_event(
-                event_type,
-                client_id=(data.get("clientId") or "").strip(),
-                session_id=(data.get("sessionId") or "").strip(),
-                path=(data.get("path") or "").strip(),
-                city_input=(data.get("cityInput") or "").strip(),
-                city_resolved=(data.get("cityResolved") or "").strip(),
-                country=(data.get("country") or "").strip(),
-                country_code=(data.get("countryCode") or "").strip(),
-                target_date=(data.get("targetDate") or "").strip(),
-                purpose=(data.get("purpose") or "").strip(),
-                link_url=(data.get("linkUrl") or "").strip(),
-                error_code=(data.get("errorCode") or "").strip(),
-                error_message=(data.get("errorMessage") or "").strip(),
-                load_ms=data.get("loadMs"),
-                meta=data.get("meta") or {},
-            )
-            self.send_json(200, {"ok": True})
-        except Exception as error:
-            self.send_json(500, {"error": str(error)})
-
-    def handle_weather(self, query: str):
-        params = parse_qs(query)
-        city = (params.get("city", [""])[0] or "").strip()
-        requested_date = (params.get("date", [""])[0] or "").strip()
-        purpose = (params.get("purpose", [""])[0] or "").strip()
-        client_id = (params.get("clientId", [""])[0] or "").strip()
-        session_id = (params.get("sessionId", [""])[0] or "").strip()
-
-        if not city:
-            self.send_json(400, {"error": "Укажите город в параметре city"})
-            return
-        if not requested_date:
-            self.send_json(400, {"error": "Укажите дату в параметре date"})
-            return
+    if method == "POST":
+        if parsed.path == "/api/analytics-login":
+            return analytics_login_response(body or b"{}")
+        if parsed.path == "/api/track":
+            return await loop.run_in_executor(None, track_response, body or b"{}")
+        return 404, {}, b""
 
-        try:
-            selected_date = date.fromisoformat(requested_date)
-        except ValueError:
-            self.send_json(400, {"error": "Неверный формат даты. Используйте YYYY-MM-DD"})
-            return
+    return 501, {"Content-Type": "text/plain; charset=utf-8"}, b"Unsupported method"
 
-        today = date.today()
-        max_supported_date = today + timedelta(days=15)
-        if selected_date < today or selected_date > max_supported_date:
-            self.send_json(
-                400,
-                {
-                    "error": (
-                        f"Можно выбрать дату только с {today.isoformat()} "
-                        f"по {max_supported_date.isoformat()}"
-                    )
-                },
-            )
-            return
 
-        try:
-            location = self.geocode_city(city)
-            weather = self.fetch_weather(location["lat"], location["lon"], requested_date)
+async def read_request_head(reader):
+    request_line = await asyncio.wait_for(reader.readline(), ASYNC_KEEPALIVE_TIMEOUT)
+    if not request_line:
+        return None
+    method, target, version = request_line.decode("latin-1").split()
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), ASYNC_KEEPALIVE_TIMEOUT)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+        if len(headers) > 100:
+            raise ValueError("Too many headers")
+    return method.upper(), target, version.upper(), headers
 
-            log_event(
-                "weather_search",
-                client_id=client_id,
-                session_id=session_id,
-                path="/api/weather",
-                city_input=city,
-                city_resolved=location.get("resolved_city"),
-                country=location.get("country"),
-                country_code=location.get("country_code"),
-                target_date=requested_date,
-                purpose=purpose,
-            )
 
-            self.send_json(
-                200,
-                {
-                    "city": location.get("resolved_city") or city,
-                    "date": requested_date,
-                    "tempMin": weather.get("temperature_2m_min"),
-                    "tempMax": weather.get("temperature_2m_max"),
-                    "feelsLikeMin": weather.get("apparent_temperature_min"),
-                    "feelsLikeMax": weather.get("apparent_temperature_max"),
-                    "weatherCode": weather.get("weather_code"),
-                    "country": location.get("country"),
-                },
+async def handle_async_connection(reader, writer):
+    try:
+        while True:
+            try:
+                head = await read_request_head(reader)
+            except (asyncio.TimeoutError, ConnectionError, asyncio.LimitOverrunError):
+                return
+            except ValueError:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            if head is None:
+                return
+
+            method, target, version, headers = head
+            started = time.perf_counter()
+            error = request_body_error(headers.get("content-length"))
+            body = b"" if error else await reader.readexactly(int(headers.get("content-length") or 0))
+            connection = headers.get("connection", "").lower()
+            keep_alive = error is None and (
+                (version == "HTTP/1.1" and connection != "close")
+                or (version == "HTTP/1.0" and connection == "keep-alive")
             )
-        except Exception as error:
-            log_event(
-                "error",
-                client_id=client_id,
-                session_id=session_id,
-                path="/api/weather",
-                city_input=city,
-                target_date=requested_date,
-                purpose=purpose,
-                error_code="weather_fetch_failed",
-                error_message=str(error),
+
+            deferred = []
+            try:
+                status, response_headers, response_body = error or await dispatch_async(
+                    method, target, headers, body, deferred
+                )
+            except Exception as error:
+                status, response_headers, response_body = json_response(
+                    500, {"error": str(error)}
+                )
+            status, response_headers, response_body = compress_response(
+                status, response_headers, response_body, headers.get("accept-encoding")
             )
-            self.send_json(500, {"error": str(error)})
-
-    def geocode_city(self, city: str):
-        city_q = quote(city, safe="", encoding="utf-8", errors="strict")
-        url = (
-            "https://nominatim.openstreetmap.org/search"
-            f"?q={city_q}&format=json&limit=1&addressdetails=1"
-        )
-        req = Request(
-            url,
-            headers={
-                "User-Agent": "simple-weather-app-analytics/1.0",
-                "Accept-Language": "ru",
-            },
-        )
-        with urlopen(req, timeout=15) as response:
-            data = json.loads(response.read().decode("utf-8"))
 
-        if not data:
-            raise ValueError("Город не найден")
+            lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+            lines.extend(f"{name}: {value}" for name, value in response_headers.items())
+            lines.append(f"Content-Length: {len(response_body)}")
+            lines.append(f"Date: {formatdate(usegmt=True)}")
+            lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            if method != "HEAD":
+                writer.write(response_body)
+            await writer.drain()
+            observe_request(urlparse(target).path, status, started)
+            if deferred:
+                asyncio.get_running_loop().run_in_executor(None, log_events, deferred)
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
 
-        first = data[0]
-        address = first.get("address") or {}
-        resolved_city = (
-            address.get("city")
-            or address.get("town")
-            or address.get("village")
-            or first.get("display_name", city).split(",")[0].strip()
-        )
-        return {
-            "lat": first["lat"],
-            "lon": first["lon"],
-            "resolved_city": resolved_city,
-            "country": address.get("country"),
-            "country_code": (address.get("country_code") or "").upper(),
-        }
 
-    def fetch_weather(self, lat: str, lon: str, requested_date: str):
-        params = urlencode(
-            {
-                "latitude": lat,
-                "longitude": lon,
-                "daily": (
-                    "temperature_2m_min,temperature_2m_max,"
-                    "apparent_temperature_min,apparent_temperature_max,weather_code"
-                ),
-                "start_date": requested_date,
-                "end_date": requested_date,
-                "timezone": "auto",
-            },
-            encoding="utf-8",
-            errors="strict",
-        )
-        url = f"https://api.open-meteo.com/v1/forecast?{params}"
-        req = Request(url)
-        with urlopen(req, timeout=15) as response:
-            data = json.loads(response.read().decode("utf-8"))
+async def serve_async(host: str, port: int, reuse_port: bool = False):
+    server = await asyncio.start_server(handle_async_connection, host, port, reuse_port=reuse_port)
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+    print(f"Server started (asyncio): http://{host}:{port}")
+    async with server:
+        await stop
+    await ASYNC_UPSTREAM.close()
 
-        daily = data.get("daily")
-        if not daily:
-            raise ValueError("Некорректный ответ Open-Meteo")
 
-        return {
-            "temperature_2m_min": self.first_value(daily, "temperature_2m_min"),
-            "temperature_2m_max": self.first_value(daily, "temperature_2m_max"),
-            "apparent_temperature_min": self.first_value(daily, "apparent_temperature_min"),
-            "apparent_temperature_max": self.first_value(daily, "apparent_temperature_max"),
-            "weather_code": self.first_value(daily, "weather_code"),
-        }
+def run_threading_server(reuse_port: bool = False):
+    handler = partial(WeatherHandler, directory=BASE_DIR)
+    server = ThreadingHTTPServer((HOST, PORT), handler, bind_and_activate=False)
+    server.allow_reuse_port = reuse_port
+    try:
+        server.server_bind()
+        server.server_activate()
+    except BaseException:
+        server.server_close()
+        raise
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Server started: http://{HOST}:{PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
-    def send_json(self, status: int, payload: dict):
-        body = json.dumps(payload, ensure_ascii=True).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
 
-    @staticmethod
-    def first_value(obj: dict, key: str):
-        value = obj.get(key)
-        if isinstance(value, list) and value:
-            return value[0]
-        return None
+def serve(reuse_port: bool = False):
+    if SERVER_MODE == "asyncio":
+        asyncio.run(serve_async(HOST, PORT, reuse_port))
+    else:
+        run_threading_server(reuse_port)
+
+
+def spawn(target, *args):
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        target(*args)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def run_analytics_writer(listener):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    FORECAST_WARMER.start()
+    receivers = []
+
+    def receive(conn):
+        with conn:
+            for rows in read_frames(conn):
+                ANALYTICS_WRITER.submit(rows)
+
+    try:
+        while True:
+            conn, _ = listener.accept()
+            thread = threading.Thread(target=receive, args=(conn,), name="analytics-receiver", daemon=True)
+            thread.start()
+            receivers.append(thread)
+            receivers = [thread for thread in receivers if thread.is_alive()]
+    finally:
+        FORECAST_WARMER.stop()
+        listener.close()
+        for thread in receivers:
+            thread.join(5)
+        ANALYTICS_WRITER.close()
+
+
+def run_worker(listener, socket_path: str):
+    global ANALYTICS_WRITER
+    listener.close()
+    ANALYTICS_WRITER = AnalyticsForwarder(
+        socket_path,
+        ANALYTICS_QUEUE_SIZE,
+        ANALYTICS_BATCH_SIZE,
+        ANALYTICS_FLUSH_INTERVAL,
+        ANALYTICS_QUEUE_POLICY,
+    )
+    try:
+        serve(reuse_port=True)
+    finally:
+        ANALYTICS_WRITER.close()
+
+
+def stop_processes(pids, timeout: float = 15.0):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    pending = set(pids)
+    while pending and time.monotonic() < deadline:
+        for pid in list(pending):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                pending.discard(pid)
+        time.sleep(0.05)
+    for pid in pending:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def serve_workers(workers: int):
+    socket_path = ANALYTICS_WRITER_SOCKET or os.path.join(
+        tempfile.gettempdir(), f"weather-analytics-{os.getpid()}.sock"
+    )
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(workers * 2)
+
+    writer = spawn(run_analytics_writer, listener)
+    children = {spawn(run_worker, listener, socket_path): time.monotonic() for _ in range(workers)}
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    failed = False
+    print(f"Server started ({workers} workers, {SERVER_MODE}): http://{HOST}:{PORT}")
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid == writer:
+                print("Analytics writer exited, restarting", file=sys.stderr)
+                writer = spawn(run_analytics_writer, listener)
+            elif pid in children:
+                started = children.pop(pid)
+                if time.monotonic() - started < 1:
+                    print(f"Worker {pid} failed to start, shutting down", file=sys.stderr)
+                    failed = True
+                    break
+                print(f"Worker {pid} exited with status {status}, restarting", file=sys.stderr)
+                children[spawn(run_worker, listener, socket_path)] = time.monotonic()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        stop_processes(list(children))
+        stop_processes([writer])
+        listener.close()
+        os.unlink(socket_path)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     init_db()
-    handler = partial(WeatherHandler, directory=BASE_DIR)
-    server = ThreadingHTTPServer((HOST, PORT), handler)
-    print(f"Server started: http://{HOST}:{PORT}")
-    server.serve_forever()
+    STATIC_CACHE.load()
+    CITY_INDEX.load()
+    if SERVER_WORKERS > 1:
+        serve_workers(SERVER_WORKERS)
+    else:
+        FORECAST_WARMER.start()
+        try:
+            serve()
+        finally:
+            FORECAST_WARMER.stop()
+            ANALYTICS_WRITER.close()
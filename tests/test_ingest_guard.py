@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+TEMP_DIR = tempfile.TemporaryDirectory()
+os.environ["DB_PATH"] = os.path.join(TEMP_DIR.name, "analytics.db")
+
+import server  # noqa: E402
+
+
+def track(payload):
+    status, _, body = server.track_response(json.dumps(payload).encode("utf-8"))
+    return status, json.loads(body)
+
+
+class IngestGuardTest(unittest.TestCase):
+    def setUp(self):
+        self.guard = server.IngestGuard(rate=0.001, burst=2, max_clients=100, sampling={})
+        patches = (
+            mock.patch.object(server, "INGEST_GUARD", self.guard),
+            mock.patch.object(server, "log_events"),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_events_without_client_id_are_not_rate_limited(self):
+        statuses = [track({"eventType": "page_view"})[0] for _ in range(20)]
+
+        self.assertEqual(statuses, [200] * 20)
+        self.assertEqual(self.guard.stats()["rateLimited"], 0)
+        self.assertEqual(self.guard.stats()["clients"], 0)
+
+    def test_client_bucket_does_not_affect_anonymous_events(self):
+        statuses = [track({"eventType": "page_view", "clientId": "c1"})[0] for _ in range(3)]
+        status, body = track(
+            [
+                {"eventType": "page_view", "clientId": "c1"},
+                {"eventType": "page_view"},
+                {"eventType": "page_view", "clientId": "c2"},
+            ]
+        )
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            body["results"],
+            [{"ok": False, "error": "rate limit exceeded"}, {"ok": True}, {"ok": True}],
+        )
+        self.assertEqual(self.guard.stats()["rateLimited"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import math
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+TEMP_DIR = tempfile.TemporaryDirectory()
+os.environ["DB_PATH"] = os.path.join(TEMP_DIR.name, "analytics.db")
+
+import server  # noqa: E402
+
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+DAYS = ("2025-03-01", "2025-03-02", "2025-03-03")
+
+
+def exact_quantile(values, q):
+    ordered = sorted(values)
+    return ordered[min(math.floor(q * len(ordered)), len(ordered) - 1)]
+
+
+def synthetic_load_times(rng, count, mu, sigma):
+    return [rng.lognormvariate(mu, sigma) for _ in range(count)]
+
+
+def perf_row(day: str, load_ms: float):
+    row = server.build_event_row("page_perf", client_id="test", load_ms=load_ms)
+    row["ts"] = f"{day}T12:00:00+00:00"
+    return row
+
+
+class QuantileSketchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        server.init_db()
+
+    def assert_within_accuracy(self, estimate, exact):
+        self.assertLessEqual(
+            abs(estimate - exact), server.PERF_SKETCH_ACCURACY * exact + 1e-9, (estimate, exact)
+        )
+
+    def test_merged_daily_sketches_match_exact_quantiles(self):
+        rng = random.Random(20250301)
+        values_by_day = {
+            DAYS[0]: synthetic_load_times(rng, 5000, 6.0, 0.5),
+            DAYS[1]: synthetic_load_times(rng, 2000, 6.5, 0.9),
+            DAYS[2]: synthetic_load_times(rng, 8000, 5.5, 0.3),
+        }
+        conn = server.db_connect()
+        try:
+            for day, values in values_by_day.items():
+                rows = [perf_row(day, value) for value in values]
+                for offset in range(0, len(rows), 500):
+                    with conn:
+                        server.apply_rollups(conn, rows[offset : offset + 500])
+        finally:
+            conn.close()
+
+        ranges = ((DAYS[0], DAYS[0]), (DAYS[0], DAYS[1]), (DAYS[1], DAYS[2]), (DAYS[0], DAYS[2]))
+        for start, end in ranges:
+            values = [
+                value
+                for day, day_values in values_by_day.items()
+                if start <= day <= end
+                for value in day_values
+            ]
+            estimates = server.perf_quantiles(start, end, QUANTILES)
+            for q in QUANTILES:
+                with self.subTest(start=start, end=end, q=q):
+                    self.assert_within_accuracy(estimates[q], exact_quantile(values, q))
+
+    def test_round_trip_preserves_sketch(self):
+        rng = random.Random(7)
+        sketch = server.QuantileSketch()
+        for value in synthetic_load_times(rng, 3000, 6.0, 1.2) + [0.0, 0.0]:
+            sketch.add(value)
+
+        restored = server.QuantileSketch.from_bytes(sketch.to_bytes())
+
+        self.assertEqual(restored.relative_accuracy, sketch.relative_accuracy)
+        self.assertEqual(restored.zero_count, sketch.zero_count)
+        self.assertEqual(restored.bins, sketch.bins)
+        for q in QUANTILES:
+            self.assertEqual(restored.quantile(q), sketch.quantile(q))
+
+    def test_non_finite_values_are_ignored(self):
+        sketch = server.QuantileSketch()
+        for value in (float("nan"), float("inf"), 120.0, 1e308):
+            sketch.add(value)
+
+        self.assertEqual(sketch.count, 2)
+        self.assertEqual(server.QuantileSketch.from_bytes(sketch.to_bytes()).count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()